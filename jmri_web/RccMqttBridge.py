@@ -16,12 +16,127 @@
 
 import jmri
 import java
+import re
 import json
 import time
+import array
+import threading
 from java.lang import String
 from org.eclipse.paho.client.mqttv3 import MqttClient, MqttConnectOptions, MqttCallback, MqttMessage
 from org.slf4j import LoggerFactory
 
+# Function bits F0-F28 of the heartbeat bitstate
+FUNCTION_MASK = (1 << 29) - 1
+
+# RCC_LOCO_LIST is rewritten right away on intro or a new loco, heartbeats only refresh
+# last_seen in it this often (seconds)
+LOCO_LIST_REFRESH = 10
+
+# RCC_SNAPSHOT (all locos and the status as one versioned JSON) and RCC_DELTA (only the
+# locos changed since the previous version, for WebSocket listeners) are rewritten at most
+# this often and only if something changed (milliseconds)
+SNAPSHOT_PERIOD = 250
+
+# Telemetry history kept per loco: (tier name, seconds averaged per sample - 0 keeps every
+# heartbeat, samples kept). Defaults hold ~2 min raw at 5 Hz, 10 min of 1 s and 2 h of 10 s
+HISTORY_TIERS = [('raw', 0, 600), ('1s', 1, 600), ('10s', 10, 720)]
+
+# History requests name the client, the answer goes to memory RCC_HISTORY_<client>
+HISTORY_CLIENT = re.compile(r'^[A-Za-z0-9]{1,16}$')
+
+class TelemetryRing(object):
+    """Fixed-size ring of samples: time and one column per key, all in preallocated arrays"""
+    def __init__(self, capacity, width):
+        self.capacity = capacity
+        self.times = array.array('d', [0.0] * capacity)
+        self.columns = [array.array('d', [0.0] * capacity) for i in range(width)]
+        self.head = 0
+        self.count = 0
+    
+    def append(self, t, values):
+        i = self.head
+        self.times[i] = t
+        for n in range(len(values)):
+            self.columns[n][i] = values[n]
+        self.head = (i + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+    
+    def window(self, since):
+        """Ring indexes of the samples newer than since, oldest first"""
+        start = self.head - self.count
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.times[(start + mid) % self.capacity] > since:
+                hi = mid
+            else:
+                lo = mid + 1
+        return [(start + n) % self.capacity for n in range(lo, self.count)]
+
+class TelemetryTier(object):
+    """One history tier, samples are averaged over period seconds (0 keeps every one)"""
+    def __init__(self, name, period, capacity, width):
+        self.name = name
+        self.period = period
+        self.ring = TelemetryRing(capacity, width)
+        self.bucket = None
+        self.sums = [0.0] * width
+        self.samples = 0
+    
+    def add(self, t, values):
+        if not self.period:
+            self.ring.append(t, values)
+            return
+        bucket = int(t // self.period)
+        if bucket != self.bucket:
+            self.flush()
+            self.bucket = bucket
+        for n in range(len(values)):
+            self.sums[n] += values[n]
+        self.samples += 1
+    
+    def flush(self):
+        if self.samples:
+            self.ring.append(self.bucket * self.period, [v / self.samples for v in self.sums])
+            self.sums = [0.0] * len(self.sums)
+            self.samples = 0
+
+class TelemetryHistory(object):
+    """Numeric telemetry of one loco in all HISTORY_TIERS"""
+    def __init__(self, keys):
+        self.keys = keys
+        self.source = None
+        self.tiers = dict([(name, TelemetryTier(name, period, capacity, len(keys)))
+                           for name, period, capacity in HISTORY_TIERS])
+        self.lock = threading.Lock()
+    
+    def add(self, t, values):
+        self.lock.acquire()
+        try:
+            for tier in self.tiers.values():
+                tier.add(t, values)
+        finally:
+            self.lock.release()
+    
+    def window(self, tier_name, since, keys=None):
+        """Columnar samples newer than since (seconds): t0 and offsets in ms, one list per key"""
+        tier = self.tiers[tier_name]
+        keys = [k for k in (keys or self.keys) if k in self.keys]
+        self.lock.acquire()
+        try:
+            ring = tier.ring
+            idx = ring.window(since)
+            times = [ring.times[i] for i in idx]
+            values = {}
+            for k in keys:
+                column = ring.columns[self.keys.index(k)]
+                values[k] = [None if column[i] != column[i] else column[i] for i in idx]
+        finally:
+            self.lock.release()
+        t0 = int(times[0] * 1000) if times else 0
+        return {'tier': tier_name, 't0': t0, 't': [int(t * 1000) - t0 for t in times], 'values': values}
+
 class RccMqttBridge(MqttCallback):
     def __init__(self):
         self.log = LoggerFactory.getLogger("jmri.jython.RccMqttBridge")
@@ -31,11 +146,20 @@ class RccMqttBridge(MqttCallback):
         self.locomotives = {}
         self.locomotive_keys = {}
         self.memory_manager = jmri.InstanceManager.getDefault(jmri.MemoryManager)
+        self.memories = {}
+        self.memory_values = {}
+        self.loco_list_time = 0
+        self.snapshot_parts = {}
+        self.snapshot_version = 0
+        self.snapshot_dirty = False
+        self.snapshot_changed = set()
+        self.histories = {}
         
         self.log.info("=" * 60)
         self.log.info("RCC MQTT Bridge for JMRI")
         self.log.info("=" * 60)
         self.connect_mqtt()
+        self.start_snapshot_publisher()
         
     def connect_mqtt(self):
         try:
@@ -57,10 +181,11 @@ class RccMqttBridge(MqttCallback):
             
             self.log.info("Connected to MQTT broker")
             self.log.info("Subscribed to RCC topics")
-            self.set_memory("RCC_STATUS", "CONNECTED")
+            self.set_status("CONNECTED")
             
-            # Create command memory variable
+            # Create command memory variables
             self.set_memory("RCC_CMD", "")
+            self.set_memory("RCC_HISTORY_REQ", "")
             
             # Start command monitoring
             self.start_command_monitor()
@@ -69,11 +194,11 @@ class RccMqttBridge(MqttCallback):
             
         except Exception as e:
             self.log.error("Failed to connect: " + str(e))
-            self.set_memory("RCC_STATUS", "DISCONNECTED")
+            self.set_status("DISCONNECTED")
     
     def connectionLost(self, cause):
         self.log.error("MQTT connection lost: " + str(cause))
-        self.set_memory("RCC_STATUS", "DISCONNECTED")
+        self.set_status("DISCONNECTED")
         self.log.info("Attempting to reconnect...")
         try:
             self.connect_mqtt()
@@ -146,16 +271,9 @@ class RccMqttBridge(MqttCallback):
             direction = direction_map.get(direction_bits, 'UNKNOWN')
             telemetry['direction'] = direction
             
-            # Extract function states from bitstate (lower 29 bits)
-            # Each bit represents a function F0-F28
-            function_states = {}
-            for i in range(29):
-                bit_value = (bitstate >> i) & 0x1
-                function_states['F' + str(i)] = bit_value
-            telemetry['functions'] = function_states
-            
             # Update locomotive data
-            if loco_id not in self.locomotives:
+            new_loco = loco_id not in self.locomotives
+            if new_loco:
                 self.locomotives[loco_id] = {
                     'id': loco_id,
                     'name': 'Loco ' + loco_id,
@@ -164,21 +282,39 @@ class RccMqttBridge(MqttCallback):
             
             loco = self.locomotives[loco_id]
             loco['last_seen'] = int(time.time() * 1000)
+            
+            # Extract function states from bitstate (lower 29 bits)
+            # Each bit represents a function F0-F28, only the bits that flipped since
+            # the last heartbeat are visited (all of them on the first one)
+            function_states = loco.setdefault('function_states', {})
+            if 'bitstate' in loco:
+                changed = (bitstate ^ loco['bitstate']) & FUNCTION_MASK
+            else:
+                changed = FUNCTION_MASK
+            loco['bitstate'] = bitstate
+            while changed:
+                i = (changed & -changed).bit_length() - 1
+                changed &= changed - 1
+                func_key = 'F' + str(i)
+                function_states[func_key] = (bitstate >> i) & 0x1
+                self.update_memory("RCC_" + loco_id + "_" + func_key, str(function_states[func_key]))
+            telemetry['functions'] = function_states
             loco['telemetry'] = telemetry
             
-            # Store in memory variables
+            # Store in memory variables, JMRI is only touched for values that changed
             for key, value in telemetry.items():
-                if key == 'functions':
-                    # Store individual function states
-                    for func_key, func_value in value.items():
-                        mem_name = "RCC_" + loco_id + "_" + func_key
-                        self.set_memory(mem_name, str(func_value))
-                else:
+                if key != 'functions':
                     mem_name = "RCC_" + loco_id + "_" + key.upper()
-                    self.set_memory(mem_name, str(value))
+                    self.update_memory(mem_name, str(value))
+            
+            self.update_snapshot(loco_id)
+            self.record_history(loco_id, telemetry)
             
             # Update locomotive list
-            self.update_loco_list()
+            if new_loco:
+                self.update_loco_list()
+            else:
+                self.refresh_loco_list()
             
         except Exception as e:
             import traceback
@@ -214,6 +350,7 @@ class RccMqttBridge(MqttCallback):
                 
                 self.log.info("Loco " + loco_id + " introduced: " + parts[2].strip() + " (v" + parts[3].strip() + ")")
                 self.update_loco_list()
+                self.update_snapshot(loco_id)
                 
                 # Schedule function list request to run outside callback thread
                 self.schedule_function_list_request(loco_id)
@@ -313,6 +450,7 @@ class RccMqttBridge(MqttCallback):
                 import json
                 func_json = json.dumps(functions)
                 self.set_memory("RCC_" + loco_id + "_FUNCTIONS", func_json)
+                self.update_snapshot(loco_id)
             
         except Exception as e:
             import traceback
@@ -330,36 +468,148 @@ class RccMqttBridge(MqttCallback):
                 'last_seen': loco.get('last_seen', 0)
             })
         
-        self.set_memory("RCC_LOCO_LIST", json.dumps(loco_list))
+        self.update_memory("RCC_LOCO_LIST", json.dumps(loco_list))
+        self.loco_list_time = time.time()
     
-    def set_memory(self, name, value):
-        try:
+    def refresh_loco_list(self):
+        """Rewrite RCC_LOCO_LIST for last_seen at most every LOCO_LIST_REFRESH seconds"""
+        if time.time() - self.loco_list_time >= LOCO_LIST_REFRESH:
+            self.update_loco_list()
+    
+    def record_history(self, loco_id, telemetry):
+        """Add the numeric telemetry of a heartbeat to the loco history, new keys start a new history"""
+        source = self.locomotive_keys[loco_id]
+        history = self.histories.get(loco_id)
+        if history is None or history.source is not source:
+            keys = [k.strip().lower() for k in source]
+            if history is None or history.keys != keys:
+                history = self.histories[loco_id] = TelemetryHistory(keys)
+            history.source = source
+        history.add(time.time(), [telemetry.get(k, float('nan')) for k in history.keys])
+    
+    def process_history(self, request_json):
+        """Answer a history request from RCC_HISTORY_REQ in RCC_HISTORY_<client> (RCC_HISTORY without
+        a client), the request id is echoed back"""
+        request = json.loads(request_json)
+        loco_id = str(request.get('loco', ''))
+        tier = str(request.get('tier', 'raw'))
+        since = float(request.get('since', 0)) / 1000.0
+        history = self.histories.get(loco_id)
+        if history is not None and tier in history.tiers:
+            result = history.window(tier, since, request.get('keys'))
+        else:
+            result = {'tier': tier, 't0': 0, 't': [], 'values': {}}
+        result['id'] = request.get('id')
+        result['loco'] = loco_id
+        reply = "RCC_HISTORY"
+        client = str(request.get('client', ''))
+        if HISTORY_CLIENT.match(client):
+            reply += "_" + client
+        self.set_memory(reply, json.dumps(result, separators=(",", ":")))
+    
+    def update_snapshot(self, loco_id):
+        """Encode the snapshot part of one loco, RCC_SNAPSHOT itself is rewritten by the snapshot timer"""
+        loco = self.locomotives[loco_id]
+        telemetry = dict(loco.get('telemetry', {}))
+        telemetry.pop('functions', None)
+        part = {
+            'name': loco.get('name', 'Loco ' + loco_id),
+            'address': loco.get('address', loco_id),
+            'version': loco.get('version', ''),
+            'last_seen': loco.get('last_seen', 0),
+            'telemetry': telemetry,
+            'functions': loco.get('function_states', {}),
+            'function_list': loco.get('functions', [])
+        }
+        self.snapshot_parts[loco_id] = json.dumps(part, separators=(",", ":"))
+        self.snapshot_changed.add(loco_id)
+        self.snapshot_dirty = True
+    
+    def publish_snapshot(self):
+        """Write the status and all locos as one JSON to RCC_SNAPSHOT and the changed ones to RCC_DELTA,
+        the version grows by one with every write"""
+        if not self.snapshot_dirty:
+            return
+        self.snapshot_dirty = False
+        changed = self.snapshot_changed
+        self.snapshot_changed = set()
+        self.snapshot_version += 1
+        parts = self.snapshot_parts
+        status = json.dumps(self.memory_values.get("RCC_STATUS", ""))
+        locos = ",".join([json.dumps(loco_id) + ":" + part for loco_id, part in parts.items()])
+        self.set_memory("RCC_SNAPSHOT", '{"version":%d,"status":%s,"locos":{%s}}' % (self.snapshot_version, status, locos))
+        locos = ",".join([json.dumps(loco_id) + ":" + parts[loco_id] for loco_id in changed])
+        self.set_memory("RCC_DELTA", '{"version":%d,"status":%s,"locos":{%s}}' % (self.snapshot_version, status, locos))
+    
+    def start_snapshot_publisher(self):
+        """Rewrite RCC_SNAPSHOT every SNAPSHOT_PERIOD ms if anything changed"""
+        from java.util import Timer, TimerTask
+        
+        class SnapshotTask(TimerTask):
+            def __init__(self, bridge):
+                self.bridge = bridge
+                
+            def run(self):
+                try:
+                    self.bridge.publish_snapshot()
+                except Exception as e:
+                    self.bridge.log.error("Error publishing snapshot: " + str(e))
+        
+        self.snapshot_timer = Timer()
+        self.snapshot_task = SnapshotTask(self)
+        self.snapshot_timer.scheduleAtFixedRate(self.snapshot_task, SNAPSHOT_PERIOD, SNAPSHOT_PERIOD)
+    
+    def set_status(self, status):
+        self.set_memory("RCC_STATUS", status)
+        self.snapshot_dirty = True
+    
+    def get_memory(self, name):
+        """Memory object by name, created on first use and cached"""
+        memory = self.memories.get(name)
+        if memory is None:
             memory = self.memory_manager.getMemory(name)
             if memory is None:
                 memory = self.memory_manager.newMemory(name, name)
-            memory.setValue(value)
+            self.memories[name] = memory
+        return memory
+    
+    def set_memory(self, name, value):
+        try:
+            self.get_memory(name).setValue(value)
+            self.memory_values[name] = value
         except Exception as e:
             self.log.error("Error setting memory " + name + ": " + str(e))
     
+    def update_memory(self, name, value):
+        """Set memory only if the value differs from the last one written by the bridge"""
+        if self.memory_values.get(name) != value:
+            self.set_memory(name, value)
+    
     def start_command_monitor(self):
-        """Monitor RCC_CMD memory variable for commands to publish"""
+        """Monitor RCC_CMD memory variable for commands to publish and RCC_HISTORY_REQ for history requests"""
         from java.util import Timer, TimerTask
         
         class CommandMonitorTask(TimerTask):
             def __init__(self, bridge):
                 self.bridge = bridge
                 self.last_cmd = None
+                self.last_history = None
                 
             def run(self):
                 try:
                     memory = self.bridge.memory_manager.getMemory("RCC_CMD")
-                    if memory is None:
-                        return
+                    if memory is not None:
+                        cmd_value = memory.getValue()
+                        if cmd_value and cmd_value != self.last_cmd:
+                            self.last_cmd = cmd_value
+                            self.bridge.process_command(str(cmd_value))
                     
-                    cmd_value = memory.getValue()
-                    if cmd_value and cmd_value != self.last_cmd:
-                        self.last_cmd = cmd_value
-                        self.bridge.process_command(str(cmd_value))
+                    memory = self.bridge.memory_manager.getMemory("RCC_HISTORY_REQ")
+                    if memory is not None:
+                        request_value = memory.getValue()
+                        if request_value and request_value != self.last_history:
+                            self.last_history = request_value
+                            self.bridge.process_history(str(request_value))
                 except Exception as e:
                     self.bridge.log.error("Error in command monitor: " + str(e))
         
@@ -389,7 +639,10 @@ class RccMqttBridge(MqttCallback):
             if self.mqtt_client and self.mqtt_client.isConnected():
                 self.mqtt_client.disconnect()
                 self.mqtt_client.close()
-            self.set_memory("RCC_STATUS", "STOPPED")
+            if hasattr(self, 'snapshot_timer') and self.snapshot_timer:
+                self.snapshot_timer.cancel()
+            self.set_status("STOPPED")
+            self.publish_snapshot()
             self.log.info("RCC MQTT Bridge stopped")
         except Exception as e:
             self.log.error("Error stopping: " + str(e))
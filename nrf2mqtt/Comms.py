@@ -7,10 +7,21 @@
 # copies or substantial portions of the Software.
 #
 
+import os
 import re
+import sys
+import json
 import time
+import queue
+import signal
 import struct
+import asyncio
 import logging
+import threading
+import logging.handlers
+import Trace
+import Metrics
+import Wireless
 import paho.mqtt.client as mqtt
 from paho.mqtt.subscribeoptions import SubscribeOptions
 
@@ -19,7 +30,35 @@ from paho.mqtt.subscribeoptions import SubscribeOptions
 #
 MQTT_BROKER = '127.0.0.1'
 NRF_PINS = (25, 0)
+NRF_RADIOS = [                  # one entry per NRF module: CE/CSN pins, optional RF channel and node address range
+    {'pins': NRF_PINS},
+    # {'pins': (24, 1), 'channel': 100, 'nodes': range(0o100, 0o200)},
+]
+NRF_POLL_INTERVAL = 0.001
+NRF_MAX_POLL_INTERVAL = 0.02
+NRF_QUEUE_SIZE = 64
+NRF_MAX_PAYLOAD = 144           # largest packet RF24Network delivers (MAX_PAYLOAD_SIZE), longer ListCab replies are paged
+NRF_RETRY_BASE = 0.002          # first retry backoff of a node after a failed write, seconds
+NRF_RETRY_MAX = 0.5             # longest retry backoff of a node
+INTRO_WINDOW = 2.0              # seconds, an unknown node gets at most INTRO_BURST intro requests per window
+INTRO_BURST = 1
 MQTT_NODE_NAME = 'RCC_Station'
+MQTT_BATCH_WINDOW = 0           # seconds to collect publishes before a flush, 0 publishes right away (try 0.005-0.02)
+MQTT_BATCH_SIZE = 200           # flush earlier once that many publishes are pending
+MQTT_BATCH_AGGREGATE = False    # also publish all loco heartbeats of a window as one message on MQ_ALL_HEARTBEAT
+LOG_FILE = 'comms.log'
+LOG_LEVEL = logging.DEBUG
+LOG_MAX_BYTES = 4 * 1024 * 1024
+LOG_BACKUPS = 2
+TRACE_FILE = None               # e.g. 'packets.trace', binary trace of every packet (see Trace.py)
+METRICS_TOPIC = 'station/metrics'
+METRICS_PERIOD = 10             # seconds between metrics publishes on METRICS_TOPIC, 0 to disable
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 8090             # plain text metrics at http://METRICS_HOST:METRICS_PORT/, 0 to disable
+METRICS_SAMPLE = 16             # latency histograms time one packet out of that many
+SNAPSHOT_FILE = 'station.snapshot'  # known nodes and subscriptions, restored at start, None to disable
+SNAPSHOT_PERIOD = 30            # seconds between snapshot saves (only if something changed)
+SNAPSHOT_MAX_AGE = 3600         # a snapshot older than that is ignored at start, seconds
 
 #
 # NRF & MQTT protocol definition
@@ -30,18 +69,32 @@ MQ_DIRECTIONS = ['REVERSE', 'FORWARD', 'STOP', 'NEUTRAL']
 NRF_SEPARATOR = ','
 NRF_TYPE_LOCO = 'L'
 NRF_TYPE_KEYPAD = 'K'
+PROTO_NRF = 'NRF'
+PROTO_MQ = 'MQ'
 NRF_INTRO = 'A'
 NRF_SUB = 'B'
+#
+# ListCab ('C'), keypad asks for the list of known cabs:
+#   request 'C'          - reply 'C' and the entries of the first page, Type,Addr,Name separated by ','
+#                          (the reply of older stations, a short list is complete in it)
+#   request 'C' + page   - reply 'C' + page (byte) + page count (byte) and the entries of that page,
+#                          a page past the end has no entries
+#   A page holds at most NRF_MAX_PAYLOAD bytes.
+#
 NRF_LIST_CAB = 'C'
+NRF_LIST_CAB_HEADER = len(NRF_LIST_CAB) + 2   # 'C', page number, page count
 NRF_HEARTBEAT = 'H'
 NRF_PING = '0'
 MQ_INTRO = 'intro'
+MQ_ALL_HEARTBEAT = 'cab/all/heartbeat'
+MQ_STATE_TOPICS = ('heartbeat/values', 'heartbeat', 'throttle', 'direction')
 MQ_INTRO_REQ = 'intro/req'
 
 #
 # NRF to MQTT and back translation table.
 #    First column - Nrf topic (single char)
-#    Second column - conversion function with signature (bool toNrf, key, value)
+#    Second column - conversion function with signature (bool toNrf, addr, key, value)
+#                    addr - address of the node the packet is from/to, the translation context
 #                    key - present for set commands like setFunction or setValue (name/key of the thing to set). Otherwise empty str
 #                    value - a main argument of the command
 #    Third column - the MQTT topic suffix (after cab/{addr}/).
@@ -68,30 +121,27 @@ def buildTrasnlationMap():
 #
 # Translation functions, for Nrf returs list of ints, for mqtt a pair of strings (topic suffix and message).
 #
-def translateIntro(toNrf, k, v):
+def translateIntro(toNrf, addr, k, v):
     if toNrf:
         if k != '/req':
-            broker.processIntro(v, 'MQ')
+            broker.processIntro(addr, v, PROTO_MQ)
         return bytes(v, 'utf-8')
     else:
-        broker.processIntro(v.decode(), 'NRF')
+        broker.processIntro(addr, v.decode(), PROTO_NRF)
         return '', v.decode()
 
-def translateHeartbeat(toNrf, k, v):
-    fmt = broker.getHeartbeatFmt()
+def translateHeartbeat(toNrf, addr, k, v):
+    codec = broker.getHeartbeatCodec(addr)
     if toNrf:
-        if fmt is None or len(v) == 0:
+        if codec is None or len(v) == 0:
             return bytes([0])
-        v = v.split(NRF_SEPARATOR)
-        unpacked = [int(i) for i in v]
-        return struct.pack(fmt, *unpacked)
+        return codec.pack(*map(int, v.split(NRF_SEPARATOR)))
     else:
-        if fmt is None or struct.calcsize(fmt) != len(v):
+        if codec is None or codec.size != len(v):
             return '', ''
-        unpacked = struct.unpack(fmt, v)
-        return '', NRF_SEPARATOR.join( [f'{i}' for i in unpacked] )
+        return '', NRF_SEPARATOR.join(map(str, codec.unpack(v)))
 
-def translateDirection(toNrf, k, v):
+def translateDirection(toNrf, addr, k, v):
     if toNrf:
         for i, s in enumerate(MQ_DIRECTIONS):
             if v == s or v == str(i):
@@ -101,7 +151,7 @@ def translateDirection(toNrf, k, v):
         if i < len(MQ_DIRECTIONS):
             return '', MQ_DIRECTIONS[i]
 
-def translateFunctionSet(toNrf, k, v):
+def translateFunctionSet(toNrf, addr, k, v):
     if toNrf:
         v = 1 if v == 'ON' else 0
         return bytes(f'{k}{NRF_SEPARATOR}{v}', 'utf-8')
@@ -109,13 +159,13 @@ def translateFunctionSet(toNrf, k, v):
         v = v.decode().split(NRF_SEPARATOR)
         return v[0], ('ON' if v[1] == '1' else 'OFF')
 
-def translateValueSet(toNrf, k, v):
+def translateValueSet(toNrf, addr, k, v):
     if toNrf:
         return bytes(f'{k}{NRF_SEPARATOR}{v}', 'utf-8')
     else:
         return v.decode().split(NRF_SEPARATOR)
 
-def translateInt(toNrf, k, v):
+def translateInt(toNrf, addr, k, v):
     if toNrf:
         try:
             return [abs(int(v))]
@@ -124,13 +174,38 @@ def translateInt(toNrf, k, v):
     else:
         return '', str(ord(v))
 
-def translateStr(toNrf, k, v):
+def translateStr(toNrf, addr, k, v):
     if toNrf:
         return bytes(v, 'utf-8')
     else:
         return '', v.decode()
 
 
+#
+# Send priority lane and coalescing key of an outbound Nrf packet.
+#  Lanes: stop/direction, then throttle, then functions/values/everything else, then bulk list responses.
+#  State commands (throttle, direction, heartbeat and per function/value sets) get a key so a newer one
+#  replaces the pending one. Everything else is one-shot and gets None.
+#
+NRF_LANE_DIRECTION = 0
+NRF_LANE_THROTTLE = 1
+NRF_LANE_CONTROL = 2
+NRF_LANE_BULK = 3
+NRF_LANES = { ord('D'): NRF_LANE_DIRECTION, ord('T'): NRF_LANE_THROTTLE,
+              ord('C'): NRF_LANE_BULK, ord('V'): NRF_LANE_BULK, ord('J'): NRF_LANE_BULK, ord('K'): NRF_LANE_BULK }
+NRF_STATE_TOPICS = b'TDH'
+NRF_KEYED_TOPICS = b'FSM'
+
+def nrfClassify(packet):
+    if len(packet) == 0:
+        return NRF_LANE_CONTROL, None
+    lane = NRF_LANES.get(packet[0], NRF_LANE_CONTROL)
+    if packet[0] in NRF_STATE_TOPICS:
+        return lane, packet[:1]
+    if packet[0] in NRF_KEYED_TOPICS:
+        return lane, packet.split(bytes(NRF_SEPARATOR, 'utf-8'), 1)[0]
+    return lane, None
+
 #
 # Object to store/represent a translation entry (see the translation table abobe)
 #
@@ -139,103 +214,347 @@ class RouteEntry:
         self.nrfTopic = nrfTopic
         self.mqTopic = mqTopic
         self.traslateFunc = traslateFunc
+        self.count = 0
 
 #
 # Tranlator mechanism, takes one protocol and translate into another
+#  Routes are precompiled from the translation table:
+#    nrfIndex - Nrf topic char to the first entry with that topic (duplicate 'H' resolves to the first one)
+#    mqExact  - full Mqtt topic suffix to the entry the table scan would pick for it
+#    mqTrie   - char trie of Mqtt topic suffixes for prefix routes like 'function/3' or 'value/zupa'
+#  The table order still defines priority, so 'function/name/' wins over 'function/'.
 #
 class Translator:
     def __init__(self):
         self.proto_map = buildTrasnlationMap()
-
-    def toNrf(self, action, message):
+        self.nrfIndex = {}
+        self.mqExact = {}
+        self.mqTrie = {}
+        for i, entry in enumerate(self.proto_map):
+            self.nrfIndex.setdefault(entry.nrfTopic, entry)
+            node = self.mqTrie
+            for c in entry.mqTopic:
+                node = node.setdefault(c, {})
+            node.setdefault(None, i)
         for entry in self.proto_map:
-            if action.startswith(entry.mqTopic):
-                k = action.removeprefix(entry.mqTopic)
-                t = entry.traslateFunc(True, k, message)
-                if t != None:
-                    t = bytes(entry.nrfTopic, 'utf-8') + bytes(t)
-                return t
-
-    def toMq(self, action, message):
-        for entry in self.proto_map:
-            if action == entry.nrfTopic:
-                t = entry.traslateFunc(False, '', message)
-                if t != None:
-                    topic, messageOut = t
-                    if entry.mqTopic == 'heartbeat/values' and len(messageOut) == 0:
-                        return 'heartbeat', messageOut
-                    else:
-                        return entry.mqTopic + topic, messageOut
+            self.mqExact.setdefault(entry.mqTopic, self.matchMq(entry.mqTopic))
+
+    def matchMq(self, action):
+        node = self.mqTrie
+        best = node.get(None)
+        for c in action:
+            node = node.get(c)
+            if node is None:
+                break
+            i = node.get(None)
+            if i is not None and (best is None or i < best):
+                best = i
+        if best is not None:
+            return self.proto_map[best]
+
+    def routeMq(self, action):
+        entry = self.mqExact.get(action)
+        if entry is None:
+            entry = self.matchMq(action)
+        return entry
+
+    def toNrf(self, addr, action, message):
+        entry = self.routeMq(action)
+        if entry is not None:
+            entry.count += 1
+            k = action[len(entry.mqTopic):]
+            t = entry.traslateFunc(True, addr, k, message)
+            if t != None:
+                t = bytes(entry.nrfTopic, 'utf-8') + bytes(t)
+            return t
+
+    def toMq(self, addr, action, message):
+        entry = self.nrfIndex.get(action)
+        if entry is not None:
+            entry.count += 1
+            t = entry.traslateFunc(False, addr, '', message)
+            if t != None:
+                topic, messageOut = t
+                if entry.mqTopic == 'heartbeat/values' and len(messageOut) == 0:
+                    return 'heartbeat', messageOut
+                else:
+                    return entry.mqTopic + topic, messageOut
+
+#
+# Known node, one record per address. Type and Proto are interned, Format comes with its compiled codec.
+#  Records are never changed in place, an intro builds a new one, so readers always see a complete node.
+#
+class Node:
+    __slots__ = ('addr', 'type', 'name', 'version', 'proto', 'format', 'codec')
+
+    def __init__(self, addr, nodeType, name, version, proto, fmt = None):
+        self.addr = int(addr)
+        self.type = sys.intern(nodeType)
+        self.name = name
+        self.version = version
+        self.proto = sys.intern(proto)
+        self.format = fmt
+        self.codec = struct.Struct(fmt) if fmt is not None else None
+
+    def asDict(self):
+        d = {'Type': self.type, 'Addr': str(self.addr), 'Name': self.name, 'Version': self.version, 'Proto': self.proto}
+        if self.format is not None:
+            d['Format'] = self.format
+        return d
+
+    @classmethod
+    def fromDict(cls, addr, d):
+        return cls(addr, d['Type'], d['Name'], d['Version'], d['Proto'], d.get('Format'))
+
+    def __repr__(self):
+        return str(self.asDict())
+
+#
+# Address to Node, plus the sets of Nrf and Mqtt addresses. Lookups are plain dict ones, changes go
+#  through add/remove (by the Broker under its lock) to keep the sets in step.
+#
+class NodeRegistry(dict):
+    def __init__(self):
+        super().__init__()
+        self.nrf = set()
+        self.mq = set()
+
+    def add(self, node):
+        self[node.addr] = node
+        if node.proto == PROTO_NRF:
+            self.mq.discard(node.addr)
+            self.nrf.add(node.addr)
+        else:
+            self.nrf.discard(node.addr)
+            self.mq.add(node.addr)
+
+    def remove(self, addr):
+        self.pop(addr, None)
+        self.nrf.discard(addr)
+        self.mq.discard(addr)
+
+#
+# Token bucket per address for intro requests, so a chatty unknown node doesn't get an intro request
+#  back for every packet it sends. Buckets of nodes that introduced themselves are dropped with clear().
+#  Buckets idle for a window are full again, they are pruned once per window so addresses that never
+#  introduce themselves don't pile up.
+#
+class IntroLimiter:
+    def __init__(self, window, burst):
+        self.window = window
+        self.rate = burst / window
+        self.burst = burst
+        self.buckets = {}
+        self.pruned = time.monotonic()
+
+    def allow(self, addr, now = None):
+        now = time.monotonic() if now is None else now
+        if now - self.pruned > self.window:
+            self.prune(now)
+        tokens, last = self.buckets.get(addr, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1:
+            self.buckets[addr] = (tokens, now)
+            return False
+        self.buckets[addr] = (tokens - 1, now)
+        return True
+
+    def prune(self, now):
+        self.buckets = {addr: bucket for addr, bucket in self.buckets.items() if now - bucket[1] <= self.window}
+        self.pruned = now
+
+    def clear(self, addr):
+        self.buckets.pop(addr, None)
 
 #
 # Broker uses tranlator and adds routing capability (which address on Nrf & Mqtt side to route the packet).
 #  Also manages intro's and subscriptions of keypads to locos (as part of routing).
 #  Expects Nrf data arrive as char for action/topic and bytes for message
 #  Expects Mqtt adat to arrive string for both action/topic and message
+#  The node address is passed along with every packet, so receiveNrf/receiveMq can be called from several threads.
+#  Changes of known nodes and subscriptions go under a lock, readers always see a complete entry.
 #
 class Broker:
     def __init__(self):
-        self.known = {}
+        self.known = NodeRegistry()
+        self.cabEntries = {}
+        self.cabPages = None
         self.subscription = {}
+        self.lock = threading.RLock()
+        self.version = 0
+        self.savedVersion = 0
+        self.translateNrf = metrics.histogram('translate_seconds', source = 'nrf')
+        self.translateMq = metrics.histogram('translate_seconds', source = 'mq')
+        self.forwardNrf = metrics.histogram('forward_seconds', source = 'nrf')
+        self.forwardMq = metrics.histogram('forward_seconds', source = 'mq')
+        self.packets = 0
+        self.introNrf = IntroLimiter(INTRO_WINDOW, INTRO_BURST)
+        self.introMq = IntroLimiter(INTRO_WINDOW, INTRO_BURST)
+        self.unknownNrf = metrics.counter('unknown_packets', source = 'nrf')
+        self.unknownMq = metrics.counter('unknown_packets', source = 'mq')
+        self.introReqNrf = metrics.counter('intro_requests', source = 'nrf')
+        self.introReqMq = metrics.counter('intro_requests', source = 'mq')
 
     def updateFmt(self, fmt):
         return '<' + fmt[1:]
 
-    def processIntro(self, message, proto):
+    def processIntro(self, addr, message, proto):
         fields = message.split(NRF_SEPARATOR)
         if len(fields) < 4:
             return
-        m = { 'Type': fields[0], 'Addr': fields[1], 'Name': fields[2], 'Version': fields[3], 'Proto': proto}
-        if len(fields) > 4:
-            m['Format'] = self.updateFmt(fields[4])
-        if self.addr not in self.known:
-            self.known[self.addr] = {}
-        self.known[self.addr].update(m)
-        logging.info(f'New entry: {self.known[self.addr]}')
+        with self.lock:
+            old = self.known.get(addr)
+            if len(fields) > 4:
+                fmt = self.updateFmt(fields[4])
+            else:
+                fmt = old.format if old else None
+            node = Node(addr, fields[0], fields[2], fields[3], proto, fmt)
+            self.known.add(node)
+            self.updateCabEntry(node)
+            self.version += 1
+        (self.introNrf if proto == PROTO_NRF else self.introMq).clear(addr)
+        logging.info(f'New entry: {node}')
 
     def subscribe(self, addr, subTo):
         subTo = int(subTo)
-        if addr in self.subscription and subTo in self.subscription and self.subscription[addr] == subTo and self.subscription[subTo] == addr:
-            logging.info(f'Already subscribed: {addr} and {subTo}')
-        else:
-            self.unsubscribe(addr)
-            self.subscription[addr] = subTo
-            self.subscription[subTo] = addr
-            logging.info(f'Subscribe: {addr} and {subTo}')
+        with self.lock:
+            if addr in self.subscription and subTo in self.subscription and self.subscription[addr] == subTo and self.subscription[subTo] == addr:
+                logging.info(f'Already subscribed: {addr} and {subTo}')
+            else:
+                self.unsubscribe(addr)
+                self.subscription[addr] = subTo
+                self.subscription[subTo] = addr
+                self.version += 1
+                logging.info(f'Subscribe: {addr} and {subTo}')
 
     def forget(self, addr):
         logging.info(f'Forget: {addr}')
-        if addr in self.known:
-            del self.known[addr]
+        with self.lock:
+            self.known.remove(addr)
+            if self.cabEntries.pop(addr, None) is not None:
+                self.cabPages = None
+            self.version += 1
 
     def unsubscribe(self, addr):
-        if addr in self.subscription:
-            logging.info(f'Unsubscribe: {addr} and {self.subscription[addr]}')
-            subTo = self.subscription[addr]
-            del self.subscription[addr]
-            if subTo in self.subscription:
-                del self.subscription[subTo]
-
-    def processListCab(self, addr):
-        p = NRF_LIST_CAB + NRF_SEPARATOR.join( [f"{fields['Type']}{NRF_SEPARATOR}{fields['Addr']}{NRF_SEPARATOR}{fields['Name']}" for addr, fields in self.known.items()] )
-        p = bytes(p, 'utf-8')
-        nrf.write(addr, p)
+        with self.lock:
+            if addr in self.subscription:
+                logging.info(f'Unsubscribe: {addr} and {self.subscription[addr]}')
+                subTo = self.subscription[addr]
+                del self.subscription[addr]
+                if subTo in self.subscription:
+                    del self.subscription[subTo]
+                self.version += 1
+
+    #
+    # Snapshot of known nodes and subscriptions for a warm restart, the heartbeat codecs are compiled
+    #  again on load. Written to a temp file and renamed, so a crash never leaves a broken snapshot.
+    #
+    def saveSnapshot(self, filename):
+        with self.lock:
+            if self.version == self.savedVersion:
+                return False
+            known = {addr: node.asDict() for addr, node in self.known.items()}
+            snapshot = {'time': time.time(), 'known': known, 'subscription': self.subscription}
+            data = json.dumps(snapshot, separators = (',', ':'))
+            version = self.version
+        with open(filename + '.tmp', 'w') as f:
+            f.write(data)
+        os.replace(filename + '.tmp', filename)
+        self.savedVersion = version
+        return True
+
+    # A missing, stale or malformed snapshot leaves the Broker empty, the station starts cold
+    def loadSnapshot(self, filename, maxAge):
+        try:
+            with open(filename) as f:
+                snapshot = json.load(f)
+            age = time.time() - snapshot.get('time', 0)
+            if age > maxAge:
+                logging.info(f'Snapshot is stale: {age:.0f}s')
+                return False
+            known = NodeRegistry()
+            for addr, entry in snapshot['known'].items():
+                known.add(Node.fromDict(addr, entry))
+            subscription = {int(addr): int(subTo) for addr, subTo in snapshot['subscription'].items()}
+        except (OSError, ValueError, TypeError, AttributeError, KeyError, struct.error) as e:
+            logging.info(f'No snapshot loaded: {e!r}')
+            return False
+        with self.lock:
+            self.known = known
+            self.cabEntries = {}
+            self.cabPages = None
+            for node in known.values():
+                self.updateCabEntry(node)
+            self.subscription = subscription
+            self.savedVersion = self.version
+        logging.info(f'Snapshot loaded: {len(self.known)} nodes, {age:.0f}s old')
+        return True
+
+    #
+    # ListCab reply is cached. Every node keeps its encoded entry, an intro that changes it or a forget
+    #  drops the pages, they are built again on the next request.
+    # The list is split into pages of at most NRF_MAX_PAYLOAD bytes (see NRF_LIST_CAB for the format).
+    #  A request with a page number gets that page with its header, an empty request gets the first
+    #  page without the header, as older keypads expect.
+    #
+    def updateCabEntry(self, node):
+        entry = bytes(f'{node.type}{NRF_SEPARATOR}{node.addr}{NRF_SEPARATOR}{node.name}', 'utf-8')
+        limit = NRF_MAX_PAYLOAD - NRF_LIST_CAB_HEADER
+        if len(entry) > limit:
+            entry = entry[:limit].decode('utf-8', 'ignore').encode('utf-8')
+        if self.cabEntries.get(node.addr) != entry:
+            self.cabEntries[node.addr] = entry
+            self.cabPages = None
+
+    def getCabPages(self):
+        pages = self.cabPages
+        if pages is None:
+            with self.lock:
+                separator = bytes(NRF_SEPARATOR, 'utf-8')
+                limit = NRF_MAX_PAYLOAD - NRF_LIST_CAB_HEADER
+                bodies = []
+                body = b''
+                for entry in self.cabEntries.values():
+                    if body and len(body) + len(separator) + len(entry) > limit:
+                        bodies.append(body)
+                        body = b''
+                    body = body + separator + entry if body else entry
+                bodies.append(body)
+                pages = [self.getCabHeader(i, len(bodies)) + body for i, body in enumerate(bodies)]
+                self.cabPages = pages
+        return pages
+
+    def getCabHeader(self, page, count):
+        return bytes(NRF_LIST_CAB, 'utf-8') + bytes([page & 0xFF, count & 0xFF])
+
+    def processListCab(self, addr, message = b''):
+        pages = self.getCabPages()
+        if len(message) == 0:
+            nrf.write(addr, bytes(NRF_LIST_CAB, 'utf-8') + pages[0][NRF_LIST_CAB_HEADER:])
+            return
+        page = message[0]
+        nrf.write(addr, pages[page] if page < len(pages) else self.getCabHeader(page, len(pages)))
 
     def processPing(self, addr, message):
         p = NRF_PING
         p = bytes(p, 'utf-8') + message
         nrf.write(addr, p)
 
-    def getHeartbeatFmt(self):
-        if 'Format' in self.known[self.addr]:
-            return self.known[self.addr]['Format']
+    def getHeartbeatFmt(self, addr):
+        node = self.known.get(addr)
+        return node.format if node else None
+
+    # Heartbeat format compiled into struct.Struct, kept on the node until the next intro
+    def getHeartbeatCodec(self, addr):
+        node = self.known.get(addr)
+        return node.codec if node else None
 
     def getForwardNrf(self, addr):
         return self.subscription.get(int(addr), 0)
 
     def getForwardMq(self, addr):
-        k = self.known.get(addr, 0)
-        if k['Type'] == NRF_TYPE_LOCO:
+        node = self.known.get(addr)
+        if node is not None and node.type == NRF_TYPE_LOCO:
             return addr
         else:
             sub = self.subscription.get(int(addr), 0)
@@ -244,127 +563,494 @@ class Broker:
     def receiveNrf(self, addr, action, message):
         addr = int(addr)
         if addr not in self.known and action != NRF_INTRO:
-            nrf.write(addr, bytes([ord(NRF_INTRO), 0]))
+            self.unknownNrf.inc()
+            if self.introNrf.allow(addr):
+                self.introReqNrf.inc()
+                nrf.write(addr, bytes([ord(NRF_INTRO), 0]))
             return
         if action == NRF_SUB:
             self.subscribe(addr, message[0])
             return
         if action == NRF_LIST_CAB:
-            self.processListCab(addr)
+            self.processListCab(addr, message)
             return
         if action == NRF_PING:
             self.processPing(addr, message)
             return
 
 
-        self.addr = addr
-        fwdPacket = translator.toMq(action, message)
+        self.packets += 1
+        timed = self.packets % METRICS_SAMPLE == 0
+        if timed:
+            start = time.perf_counter()
+        fwdPacket = translator.toMq(addr, action, message)
+        if timed:
+            translated = time.perf_counter()
+            self.translateNrf.observe(translated - start)
         if fwdPacket is None:
             return
         fwdMqAddr = self.getForwardMq(addr)
         mq.write(fwdMqAddr, fwdPacket)
         fwdNrfAddr = self.getForwardNrf(addr)
-        if fwdNrfAddr and self.known[fwdNrfAddr]['Proto'] == 'NRF':
+        if fwdNrfAddr and fwdNrfAddr in self.known.nrf:
             nrf.write(fwdNrfAddr, bytes(action, 'utf-8') + message)
+        if timed:
+            self.forwardNrf.observe(time.perf_counter() - translated)
 
     def receiveMq(self, addr, action, message):
         addr = int(addr)
         if addr not in self.known and action != MQ_INTRO:
-            mq.write(addr, (MQ_INTRO_REQ, ''))
+            self.unknownMq.inc()
+            if self.introMq.allow(addr):
+                self.introReqMq.inc()
+                mq.write(addr, (MQ_INTRO_REQ, ''))
             return
-        self.addr = addr
-        fwdPacket = translator.toNrf(action, message)
+        self.packets += 1
+        timed = self.packets % METRICS_SAMPLE == 0
+        if timed:
+            start = time.perf_counter()
+        fwdPacket = translator.toNrf(addr, action, message)
+        if timed:
+            translated = time.perf_counter()
+            self.translateMq.observe(translated - start)
         if fwdPacket is not None:
-            if self.known[addr]['Proto'] == 'NRF':
+            if addr in self.known.nrf:
                 nrf.write(addr, fwdPacket)
             fwdNrfAddr = self.getForwardNrf(addr)
             if fwdNrfAddr:
                 nrf.write(fwdNrfAddr, fwdPacket)
+            if timed:
+                self.forwardMq.observe(time.perf_counter() - translated)
 
 #
 # Phisical connection to Nrf
 #
 class TransportNrf:
-    def __init__(self):
-        self.wireless = Wireless.Wireless(*NRF_PINS)
-        self.wireless.onReceive = self.onReceive
+    #
+    # radios - list of radio configs (see NRF_RADIOS), one Wireless with its own thread per radio
+    # backend - a single radio on that backend instead (e.g. Simulator.SimRadio)
+    # receive - callback (addr, action, message) for incoming packets, Broker.receiveNrf if not set
+    #
+    # Packets to a node go out through the radio the node was last heard on, or through the radio
+    #  whose 'nodes' range has the address, or through the first radio. A range radio takes the node
+    #  on at the first write, the first radio only writes to nodes it has heard.
+    #
+    def __init__(self, backend = None, radios = None):
+        if backend is not None:
+            radios = [{'backend': backend}]
+        elif radios is None:
+            radios = NRF_RADIOS
+        self.radios = []
+        self.ranges = []
+        for i, config in enumerate(radios):
+            pins = config.get('pins', (None, None))
+            wireless = Wireless.Wireless(*pins, pollInterval = NRF_POLL_INTERVAL, maxPollInterval = NRF_MAX_POLL_INTERVAL,
+                queueSize = NRF_QUEUE_SIZE, lanes = NRF_LANE_BULK + 1, backend = config.get('backend'),
+                retryBase = NRF_RETRY_BASE, retryMax = NRF_RETRY_MAX, channel = config.get('channel'))
+            wireless.onReceive = lambda addr, packet, radio = wireless: self.onRadioReceive(radio, addr, packet)
+            wireless.classify = nrfClassify
+            self.radios.append(wireless)
+            if 'nodes' in config:
+                self.ranges.append((config['nodes'], wireless))
+        self.routes = {}
+        self.receive = None
+        self.trace = None
 
     def start(self):
-        self.wireless.start()
+        for radio in self.radios:
+            radio.start()
 
     def stop(self):
-        self.wireless.stop()
+        for radio in self.radios:
+            radio.stop()
+
+    # The radio for addr and whether it was picked by range
+    def getRadio(self, addr):
+        radio = self.routes.get(addr)
+        if radio is not None:
+            return radio, False
+        radio = next((r for nodes, r in self.ranges if addr in nodes), None)
+        if radio is not None:
+            return radio, True
+        return self.radios[0], False
+
+    def getStats(self):
+        return [{'nodes': len(r.nodes), 'writes': r.writes, 'writeFailures': r.writeFailures, 'disconnects': r.disconnects}
+                for r in self.radios]
 
     def write(self, addr, packet):
         addr = int(addr)
-        logging.debug(f'[NF] >: {addr}/{packet}')
-        self.wireless.write(addr, packet)
+        logging.debug('[NF] >: %s/%s', addr, packet)
+        if self.trace:
+            self.trace.record(Trace.NRF_OUT, addr, packet)
+        radio, byRange = self.getRadio(addr)
+        radio.write(addr, packet, create = byRange)
+
+    def onRadioReceive(self, radio, addr, packet):
+        self.routes[addr] = radio
+        self.onReceive(addr, packet)
 
     def onReceive(self, addr, packet):
         packet = bytes(packet)
         if len(packet) < 1:
             return
-        logging.debug(f'[NF] <: {addr}/{packet}')
-        broker.receiveNrf(addr, chr(packet[0]), packet[1:])
+        logging.debug('[NF] <: %s/%s', addr, packet)
+        if self.trace:
+            self.trace.record(Trace.NRF_IN, addr, packet)
+        (self.receive or broker.receiveNrf)(addr, chr(packet[0]), packet[1:])
+
+#
+# Batching publisher for Mqtt. Publishes are collected for a window and then handed to paho in one go.
+#  Within a window a newer state (heartbeat, throttle, direction) of a topic replaces the pending one,
+#  everything else is kept in order. With aggregate on, all loco heartbeats of the window are also
+#  published as one JSON message {addr: values} on MQ_ALL_HEARTBEAT.
+#  Flushes are scheduled on the asyncio loop if there is one, otherwise on a background thread.
+#
+class MqttBatcher:
+    def __init__(self, publish, window, maxSize, aggregate = False):
+        self.publish = publish
+        self.window = window
+        self.maxSize = maxSize
+        self.aggregate = aggregate
+        self.pending = {}
+        self.heartbeats = {}
+        self.seq = 0
+        self.lock = threading.Lock()
+        self.loop = None
+        self.scheduled = False
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.run = False
+
+    def start(self, loop = None):
+        self.loop = loop
+        if loop is None:
+            self.run = True
+            self.thread = threading.Thread(target = self.flushThread, daemon = True)
+            self.thread.start()
+
+    def stop(self):
+        self.run = False
+        self.wakeup.set()
+        self.flush()
+
+    def add(self, addr, action, message, retain):
+        topic = f'{MQ_PREFIX}/{addr}/{action}'
+        with self.lock:
+            if action in MQ_STATE_TOPICS:
+                key = topic
+            else:
+                self.seq += 1
+                key = self.seq
+            self.pending[key] = (topic, message, retain)
+            if self.aggregate and action == 'heartbeat/values':
+                self.heartbeats[addr] = message
+            full = len(self.pending) >= self.maxSize
+            schedule = not self.scheduled
+            self.scheduled = True
+        if full:
+            self.flush()
+        elif schedule:
+            if self.loop:
+                self.loop.call_later(self.window, self.flush)
+            else:
+                self.wakeup.set()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            heartbeats, self.heartbeats = self.heartbeats, {}
+            self.scheduled = False
+        for topic, message, retain in pending.values():
+            self.publish(topic, message, retain)
+        if heartbeats:
+            self.publish(MQ_ALL_HEARTBEAT, json.dumps(heartbeats, separators = (',', ':')), False)
+
+    def flushThread(self):
+        while self.run:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            time.sleep(self.window)
+            self.flush()
 
 #
 # Phisical connection to Mqtt
+#  Runs paho's own network thread, or when started with an asyncio loop, plugs paho's socket into that loop.
 #
 class TransportMqtt:
+    #
+    # receive - callback (addr, action, message) for incoming messages, Broker.receiveMq if not set
+    #
     def __init__(self):
         self.mqttClient = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, protocol=mqtt.MQTTProtocolVersion.MQTTv5,
             client_id = MQTT_NODE_NAME)
         self.mqttClient.on_message = self.onReceive
+        self.mqttClient.on_connect = self.onConnect
+        self.receive = None
+        self.loop = None
+        self.miscTask = None
+        self.trace = None
+        self.published = 0
+        self.publishRate = 0.0
+        self.rateSince = (0, time.monotonic())
+        self.batcher = None
+        if MQTT_BATCH_WINDOW:
+            self.batcher = MqttBatcher(self.publish, MQTT_BATCH_WINDOW, MQTT_BATCH_SIZE, MQTT_BATCH_AGGREGATE)
 
-    def start(self):
+    def start(self, loop = None):
+        self.loop = loop
+        if self.batcher:
+            self.batcher.start(loop)
+        if loop:
+            self.mqttClient.on_socket_open = self.onSocketOpen
+            self.mqttClient.on_socket_close = self.onSocketClose
+            self.mqttClient.on_socket_register_write = self.onSocketRegisterWrite
+            self.mqttClient.on_socket_unregister_write = self.onSocketUnregisterWrite
         self.mqttClient.connect(MQTT_BROKER)
+        if loop:
+            self.miscTask = loop.create_task(self.misc())
+        else:
+            self.mqttClient.loop_start()
+
+    def stop(self):
+        if self.batcher:
+            self.batcher.stop()
+        if self.loop:
+            self.miscTask.cancel()
+            self.mqttClient.disconnect()
+        else:
+            self.mqttClient.loop_stop()
+
+    def onConnect(self, client, userdata, flags, reason, properties):
         options = SubscribeOptions(qos = 1, noLocal = True)
         self.mqttClient.subscribe(f'{MQ_PREFIX}/#', options = options)
-        self.mqttClient.loop_start()
 
-    def stop(self):
-        self.mqttClient.loop_stop()
+    def onSocketOpen(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+
+    def onSocketClose(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+
+    def onSocketRegisterWrite(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def onSocketUnregisterWrite(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    # Keepalive and reconnect, paho's loop_misc is expected to run about once a second
+    async def misc(self):
+        while True:
+            await asyncio.sleep(1)
+            if self.mqttClient.loop_misc() == mqtt.MQTT_ERR_NO_CONN:
+                try:
+                    self.mqttClient.reconnect()
+                except OSError as e:
+                    logging.error(f'Mqtt reconnect failed: {e}')
 
     def write(self, addr, packet, retain = False):
-        topic = f'{MQ_PREFIX}/{addr}/{packet[0]}'
-        message = packet[1]
-        logging.debug(f'[MQ] >: {topic} {message}')
+        logging.debug('[MQ] >: %s/%s %s', addr, packet[0], packet[1])
+        if self.trace:
+            self.trace.recordMq(Trace.MQ_OUT, addr, packet[0], packet[1])
+        if self.batcher:
+            self.batcher.add(addr, packet[0], packet[1], retain)
+            return
+        self.publish(f'{MQ_PREFIX}/{addr}/{packet[0]}', packet[1], retain)
+
+    def publish(self, topic, message, retain = False):
+        self.published += 1
         self.mqttClient.publish(topic, message, retain)
 
+    def updateRate(self):
+        now = time.monotonic()
+        count, since = self.rateSince
+        if now > since:
+            self.publishRate = (self.published - count) / (now - since)
+        self.rateSince = (self.published, now)
+
     def onReceive(self, client, userdata, msg):
         topic = msg.topic
         message = str(msg.payload, 'utf-8')
         topicRe = MQ_MESSAGE.match(topic)
         if topicRe is None:
             return
-        logging.debug(f'[MQ] <: {topic} {message}')
+        logging.debug('[MQ] <: %s %s', topic, message)
         addr, action = topicRe.groups()
-        broker.receiveMq(addr, action, message)
+        if self.trace:
+            self.trace.recordMq(Trace.MQ_IN, addr, action, message)
+        (self.receive or broker.receiveMq)(addr, action, message)
+
+#
+# A packet on its way to the Broker, carries its own context instead of the Broker keeping it.
+#
+class Packet:
+    def __init__(self, source, addr, action, message):
+        self.source = source
+        self.addr = addr
+        self.action = action
+        self.message = message
+
+#
+# Station engine: one asyncio loop owns the Broker. Mqtt runs on the loop itself, the radio thread
+#  hands its packets over with call_soon_threadsafe. All Broker processing happens in one task,
+#  packet by packet, so the Broker state needs no locking. Periodic jobs are added with every().
+#
+class Station:
+    def __init__(self, nrf, mq):
+        self.nrf = nrf
+        self.mq = mq
+        self.loop = None
+        self.queue = None
+        self.tasks = []
+        self.jobs = []
+        self.servers = []
+        self.stopped = None
+
+    def fromNrf(self, addr, action, message):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, Packet('NRF', addr, action, message))
 
+    def fromMq(self, addr, action, message):
+        self.queue.put_nowait(Packet('MQ', addr, action, message))
 
+    # A blocking job (e.g. file IO) runs in the default executor, the loop keeps going meanwhile
+    def every(self, period, func, blocking = False):
+        self.jobs.append((period, func, blocking))
+
+    # Serve a TCP port on the loop, handler is an asyncio.start_server client callback
+    def serve(self, handler, host, port):
+        self.servers.append((handler, host, port))
+
+    async def periodic(self, period, func, blocking = False):
+        while True:
+            await asyncio.sleep(period)
+            try:
+                if blocking:
+                    await self.loop.run_in_executor(None, func)
+                else:
+                    func()
+            except Exception:
+                logging.exception('Periodic job failed')
+
+    async def process(self):
+        while True:
+            p = await self.queue.get()
+            try:
+                if p.source == 'NRF':
+                    broker.receiveNrf(p.addr, p.action, p.message)
+                else:
+                    broker.receiveMq(p.addr, p.action, p.message)
+            except Exception:
+                logging.exception(f'Failed to process {p.source} {p.addr}/{p.action}')
+
+    def stop(self):
+        self.stopped.set()
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.stopped = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(sig, self.stop)
+        self.nrf.receive = self.fromNrf
+        self.mq.receive = self.fromMq
+        self.tasks.append(self.loop.create_task(self.process()))
+        for period, func, blocking in self.jobs:
+            self.tasks.append(self.loop.create_task(self.periodic(period, func, blocking)))
+        # A server is optional (diagnostics), one that can't bind is skipped and the station goes on
+        servers = []
+        for handler, host, port in self.servers:
+            try:
+                servers.append(await asyncio.start_server(handler, host, port))
+            except OSError as e:
+                logging.error(f'Server on {host}:{port} not started: {e}')
+        self.nrf.start()
+        self.mq.start(self.loop)
+        try:
+            await self.stopped.wait()
+        finally:
+            self.nrf.stop()
+            self.mq.stop()
+            for task in self.tasks:
+                task.cancel()
+            for server in servers:
+                server.close()
+
+
+#
+# Station metrics: per route counters, Broker latency histograms (see Broker) and values collected
+#  from the transports - node queue depths, retries, disconnects, radio write failures, Mqtt publish rate.
+#
+def collectStation(nrf, mq):
+    def collect():
+        values = [('route_messages', {'nrf': e.nrfTopic, 'mq': e.mqTopic}, e.count) for e in translator.proto_map]
+        for radio, w in enumerate(nrf.radios):
+            values += [('nrf_writes', {'radio': radio}, w.writes), ('nrf_write_failures', {'radio': radio}, w.writeFailures),
+                       ('nrf_disconnects', {'radio': radio}, w.disconnects), ('nrf_nodes', {'radio': radio}, len(w.nodes))]
+            for addr, link in w.getLinkStats().items():
+                values += [(f'nrf_link_{k}', {'radio': radio, 'node': addr}, v) for k, v in link.items()]
+            for lane, stats in enumerate(w.getLaneStats()):
+                values += [(f'nrf_lane_{k}', {'radio': radio, 'lane': lane}, v) for k, v in stats.items()]
+        values += [('mq_published', {}, mq.published), ('mq_publish_rate', {}, round(mq.publishRate, 2))]
+        return values
+    return collect
+
+def publishMetrics(mq):
+    mq.updateRate()
+    mq.publish(METRICS_TOPIC, json.dumps(metrics.snapshot(), separators = (',', ':'), allow_nan = False))
+
+async def serveMetrics(reader, writer):
+    try:
+        await reader.readline()
+        body = metrics.render().encode()
+        writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain\r\nContent-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+#
+# Log records go through a queue, a background listener writes them to a size-rotated file,
+#  so a slow SD card never stalls the radio or Mqtt threads. Returns the listener to stop at exit.
+#
+def setupLogging(filename = LOG_FILE, level = LOG_LEVEL, maxBytes = LOG_MAX_BYTES, backups = LOG_BACKUPS):
+    fileHandler = logging.handlers.RotatingFileHandler(filename, maxBytes = maxBytes, backupCount = backups)
+    fileHandler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    logQueue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(logQueue, fileHandler)
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(logging.handlers.QueueHandler(logQueue))
+    listener.start()
+    return listener
+
+
+metrics = Metrics.Registry()
 translator = Translator()
 broker = Broker()
 
 if __name__ == '__main__':
-    import Wireless
-
-    logging.basicConfig(level=logging.DEBUG,
-                        format='%(asctime)s %(message)s',
-                        filename='comms.log',
-                        filemode='a')
+    listener = setupLogging()
     logging.error('Start')
 
+    if SNAPSHOT_FILE:
+        broker.loadSnapshot(SNAPSHOT_FILE, SNAPSHOT_MAX_AGE)
     nrf = TransportNrf()
     mq = TransportMqtt()
-
-    nrf.start()
-    mq.start()
-
-    try:
-        while True:
-            time.sleep(1)
-    except KeyboardInterrupt:
-        nrf.stop()
-        mq.stop()
+    if TRACE_FILE:
+        trace = Trace.PacketTrace(TRACE_FILE)
+        trace.start()
+        nrf.trace = mq.trace = trace
+    station = Station(nrf, mq)
+    metrics.addCollector(collectStation(nrf, mq))
+    if METRICS_PERIOD:
+        station.every(METRICS_PERIOD, lambda: publishMetrics(mq))
+    if METRICS_PORT:
+        station.serve(serveMetrics, METRICS_HOST, METRICS_PORT)
+    if SNAPSHOT_FILE:
+        station.every(SNAPSHOT_PERIOD, lambda: broker.saveSnapshot(SNAPSHOT_FILE), blocking = True)
+    asyncio.run(station.run())
+    if SNAPSHOT_FILE:
+        broker.saveSnapshot(SNAPSHOT_FILE)
+    if TRACE_FILE:
+        trace.stop()
 
     logging.error('Stop')
+    listener.stop()
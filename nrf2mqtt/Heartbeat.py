@@ -0,0 +1,79 @@
+#
+# Copyright (c) 2024-2025 Volodymyr "Vova" Tymoshchuk
+# Distributed under MIT licence, https://github.com/vova-tymosh/RCC/blob/main/LICENSE
+# For more details go to https://github.com/vova-tymosh/RCC
+#
+# The above copyright notice shall be included in all
+# copies or substantial portions of the Software.
+#
+#
+# Batch decoding of loco heartbeats
+#
+# decodeHeartbeats() takes many raw heartbeat payloads of one loco (same intro Format) and returns
+#  the values as columns, one per field. With NumPy installed the payloads are decoded in one call through
+#  a structured dtype built from the Format and the columns are NumPy arrays, otherwise struct.iter_unpack
+#  is used and the columns are tuples. Turning the columns into CSV text is a separate, optional step.
+#
+# Usage:
+#   columns = decodeHeartbeats('<IIBBBB', payloads)
+#   text = heartbeatsCsv(columns, times)
+#
+
+import re
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# struct format chars to NumPy type codes (standard sizes, the Format is always little endian)
+DTYPE_CODES = {
+    'b': 'i1', 'B': 'u1', 'h': 'i2', 'H': 'u2', 'i': 'i4', 'I': 'u4', 'l': 'i4', 'L': 'u4',
+    'q': 'i8', 'Q': 'u8', 'e': 'f2', 'f': 'f4', 'd': 'f8', '?': '?',
+}
+FORMAT_ITEM = re.compile(r'(\d*)([a-zA-Z?])')
+
+
+#
+# Structured dtype of a heartbeat Format, None if the Format has fields NumPy can't map (or no NumPy)
+#
+def heartbeatDtype(fmt):
+    if numpy is None or fmt[:1] != '<':
+        return None
+    fields = []
+    for count, code in FORMAT_ITEM.findall(fmt[1:]):
+        if code not in DTYPE_CODES:
+            return None
+        for i in range(int(count or 1)):
+            fields.append((f'f{len(fields)}', '<' + DTYPE_CODES[code]))
+    return numpy.dtype(fields)
+
+#
+# Decode payloads (bytes of one loco) into columns. Payloads of another size than the Format
+#  are skipped, filter them beforehand when the rows have to stay aligned with something else.
+#
+def decodeHeartbeats(fmt, payloads, useNumpy = True):
+    codec = struct.Struct(fmt)
+    if set(map(len, payloads)) - {codec.size}:
+        payloads = [p for p in payloads if len(p) == codec.size]
+    data = b''.join(payloads)
+    dtype = heartbeatDtype(fmt) if useNumpy else None
+    if dtype is not None:
+        rows = numpy.frombuffer(data, dtype = dtype)
+        return [rows[name] for name in dtype.names]
+    fields = len(codec.unpack(bytes(codec.size)))
+    if not data:
+        return [()] * fields
+    return list(zip(*codec.iter_unpack(data)))
+
+#
+# CSV text of decoded columns, one heartbeat per line, optionally prefixed with time and addr
+#
+def heartbeatsCsv(columns, times = None, addr = None, separator = ','):
+    columns = [c.tolist() if hasattr(c, 'tolist') else c for c in columns]
+    if addr is not None:
+        columns.insert(0, [addr] * (len(columns[0]) if columns else len(times or ())))
+    if times is not None:
+        columns.insert(0, [f'{t:.6f}' for t in times])
+    return ''.join(separator.join(map(str, row)) + '\n' for row in zip(*columns))
@@ -0,0 +1,113 @@
+#
+# Copyright (c) 2024-2025 Volodymyr "Vova" Tymoshchuk
+# Distributed under MIT licence, https://github.com/vova-tymosh/RCC/blob/main/LICENSE
+# For more details go to https://github.com/vova-tymosh/RCC
+#
+# The above copyright notice shall be included in all
+# copies or substantial portions of the Software.
+#
+#
+# Station runtime metrics: counters, latency histograms and collected values (queue depths etc).
+#  render() gives a Prometheus-like text, snapshot() a dict for JSON.
+#
+
+import bisect
+
+# Latency buckets, seconds
+LATENCY_BUCKETS = (0.00001, 0.00002, 0.00005, 0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1)
+
+
+def metricName(name, labels):
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{k}="{v}"' for k, v in sorted(labels.items())) + '}'
+
+
+class Counter:
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n = 1):
+        self.value += n
+
+class Histogram:
+
+    def __init__(self, buckets = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    # Upper bound of the bucket holding the q quantile, None if it is past the last bucket
+    #  (JSON has no infinity, it goes out as null)
+    def quantile(self, q):
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        total = 0
+        for i, c in enumerate(self.counts):
+            total += c
+            if total >= rank:
+                return self.buckets[i] if i < len(self.buckets) else None
+
+#
+# Registry of all metrics. Collectors are callbacks returning a list of (name, labels, value),
+#  they are called on render/snapshot for values that live elsewhere, like queue depths.
+#
+class Registry:
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+
+    def counter(self, name, **labels):
+        key = metricName(name, labels)
+        if key not in self.counters:
+            self.counters[key] = Counter()
+        return self.counters[key]
+
+    def histogram(self, name, **labels):
+        key = metricName(name, labels)
+        if key not in self.histograms:
+            self.histograms[key] = Histogram()
+        return self.histograms[key]
+
+    def addCollector(self, func):
+        self.collectors.append(func)
+
+    def collect(self):
+        values = {key: c.value for key, c in self.counters.items()}
+        for func in self.collectors:
+            for name, labels, value in func():
+                values[metricName(name, labels)] = value
+        return values
+
+    def snapshot(self):
+        s = self.collect()
+        for key, h in self.histograms.items():
+            s[key] = {'count': h.count, 'sum': h.sum, 'p50': h.quantile(0.5), 'p99': h.quantile(0.99)}
+        return s
+
+    def render(self):
+        lines = [f'{key} {value}' for key, value in sorted(self.collect().items())]
+        for key, h in sorted(self.histograms.items()):
+            name, brace, labels = key.partition('{')
+            labels = labels.rstrip('}')
+            sep = ',' if labels else ''
+            total = 0
+            for bound, c in zip(self.buckets(h), h.counts):
+                total += c
+                lines.append(f'{name}_bucket{{{labels}{sep}le="{bound}"}} {total}')
+            lines.append(f'{name}_count{brace}{labels}{"}" if brace else ""} {h.count}')
+            lines.append(f'{name}_sum{brace}{labels}{"}" if brace else ""} {h.sum}')
+        return '\n'.join(lines) + '\n'
+
+    def buckets(self, h):
+        return list(h.buckets) + ['+Inf']
@@ -0,0 +1,196 @@
+#
+# Copyright (c) 2024-2025 Volodymyr "Vova" Tymoshchuk
+# Distributed under MIT licence, https://github.com/vova-tymosh/RCC/blob/main/LICENSE
+# For more details go to https://github.com/vova-tymosh/RCC
+#
+# The above copyright notice shall be included in all
+# copies or substantial portions of the Software.
+#
+#
+# Simulated RF24Network, a hardware-free radio backend for Wireless
+#
+# Usage:
+#   radio = SimRadio(loss = 0.05, latency = 0.002)
+#   radio.addNode(SimLoco(3, 'Rcc'))
+#   radio.addNode(SimKeypad(4, 'Pad', subscribeTo = 3))
+#   nrf = TransportNrf(backend = radio)
+#
+# All packets share one channel, each one occupies it for its airtime at dataRate (250 kbps by default),
+#  so the simulated throughput is bounded the same way as the real one.
+#
+
+import time
+import heapq
+import random
+import struct
+import collections
+from Comms import NRF_SEPARATOR, NRF_TYPE_LOCO, NRF_TYPE_KEYPAD, NRF_INTRO, NRF_SUB, NRF_HEARTBEAT
+
+NRF_FRAME_OVERHEAD = 10     # preamble, address, packet control field and CRC, bytes
+NRF_NETWORK_HEADER = 8      # RF24Network header, bytes
+NRF_ACK_TIME = 0.00025      # auto-ack turnaround and ack frame, seconds
+
+
+#
+# Virtual node, talks to the station the same way the firmware does.
+#
+class SimNode:
+
+    def __init__(self, addr, nodeType, name, version = '0.9'):
+        self.addr = int(addr)
+        self.nodeType = nodeType
+        self.name = name
+        self.version = version
+        self.radio = None
+        self.received = []
+
+    def introFields(self):
+        return [self.nodeType, str(self.addr), self.name, self.version]
+
+    def send(self, payload):
+        return self.radio.transmit(self.addr, self.radio.stationNode, payload)
+
+    def sendIntro(self):
+        self.send(bytes(NRF_INTRO + NRF_SEPARATOR.join(self.introFields()), 'utf-8'))
+
+    def start(self, now):
+        self.sendIntro()
+
+    def tick(self, now):
+        pass
+
+    def receive(self, now, payload):
+        self.received.append((now, payload))
+        if payload[:1] == bytes(NRF_INTRO, 'utf-8'):
+            self.sendIntro()
+
+#
+# Virtual loco, sends heartbeats every heartbeatPeriod seconds. Values are a counter followed by zeros.
+#
+class SimLoco(SimNode):
+
+    def __init__(self, addr, name, fmt = 'IIBBBB', heartbeatPeriod = 0.1, version = '0.9'):
+        super().__init__(addr, NRF_TYPE_LOCO, name, version)
+        self.fmt = fmt
+        self.codec = struct.Struct('<' + fmt)
+        self.zeros = [0] * (len(self.codec.unpack(bytes(self.codec.size))) - 1)
+        self.heartbeatPeriod = heartbeatPeriod
+        self.nextBeat = 0
+        self.beats = 0
+
+    def introFields(self):
+        return super().introFields() + ['<' + self.fmt]
+
+    def start(self, now):
+        super().start(now)
+        self.nextBeat = now + self.radio.random.random() * self.heartbeatPeriod
+
+    def tick(self, now):
+        if self.heartbeatPeriod and now >= self.nextBeat:
+            self.nextBeat += self.heartbeatPeriod
+            self.beats += 1
+            self.send(bytes(NRF_HEARTBEAT, 'utf-8') + self.codec.pack(self.beats, *self.zeros))
+
+#
+# Virtual keypad, subscribes to a loco and sends throttle every throttlePeriod seconds.
+#
+class SimKeypad(SimNode):
+
+    def __init__(self, addr, name, subscribeTo, throttlePeriod = 0.5, version = '0.9'):
+        super().__init__(addr, NRF_TYPE_KEYPAD, name, version)
+        self.subscribeTo = int(subscribeTo)
+        self.throttlePeriod = throttlePeriod
+        self.nextThrottle = 0
+        self.throttle = 0
+
+    def start(self, now):
+        super().start(now)
+        self.send(bytes(NRF_SUB, 'utf-8') + bytes([self.subscribeTo]))
+        self.nextThrottle = now + self.radio.random.random() * self.throttlePeriod
+
+    def tick(self, now):
+        if self.throttlePeriod and now >= self.nextThrottle:
+            self.nextThrottle += self.throttlePeriod
+            self.throttle = (self.throttle + 1) % 100
+            self.send(b'T' + bytes([self.throttle]))
+
+#
+# The simulated network, implements the Wireless backend methods.
+#   loss - probability for a packet to be lost (a lost station write returns False like a missing ack)
+#   latency - extra delivery delay on top of the airtime, seconds
+#   dataRate - channel bitrate, bits per second
+#
+class SimRadio:
+
+    def __init__(self, loss = 0.0, latency = 0.001, dataRate = 250000, seed = None):
+        self.loss = loss
+        self.latency = latency
+        self.dataRate = dataRate
+        self.random = random.Random(seed)
+        self.stationNode = None
+        self.nodes = {}
+        self.events = []
+        self.inbox = collections.deque()
+        self.seq = 0
+        self.airFree = 0
+        self.sent = 0
+        self.lost = 0
+        self.airtime = 0.0
+
+    def addNode(self, node):
+        node.radio = self
+        self.nodes[node.addr] = node
+        if self.stationNode is not None:
+            node.start(time.monotonic())
+        return node
+
+    def airtimeOf(self, payload):
+        return (NRF_FRAME_OVERHEAD + NRF_NETWORK_HEADER + len(payload)) * 8 / self.dataRate + NRF_ACK_TIME
+
+    def transmit(self, fromNode, toNode, payload):
+        now = time.monotonic()
+        start = max(now, self.airFree)
+        airtime = self.airtimeOf(payload)
+        self.airFree = start + airtime
+        self.airtime += airtime
+        self.sent += 1
+        if self.random.random() < self.loss:
+            self.lost += 1
+            return False
+        self.seq += 1
+        heapq.heappush(self.events, (self.airFree + self.latency, self.seq, fromNode, toNode, bytes(payload)))
+        return True
+
+    def begin(self, node):
+        self.stationNode = node
+        now = time.monotonic()
+        for n in list(self.nodes.values()):
+            n.start(now)
+
+    def update(self):
+        now = time.monotonic()
+        for node in list(self.nodes.values()):
+            node.tick(now)
+        while self.events and self.events[0][0] <= now:
+            at, seq, fromNode, toNode, payload = heapq.heappop(self.events)
+            if toNode == self.stationNode:
+                self.inbox.append((fromNode, payload))
+            elif toNode in self.nodes:
+                self.nodes[toNode].receive(now, payload)
+
+    def available(self):
+        return len(self.inbox) > 0
+
+    def read(self):
+        return self.inbox.popleft()
+
+    def write(self, toNode, payload):
+        if toNode not in self.nodes:
+            return False
+        return self.transmit(self.stationNode, toNode, payload)
+
+    def powerDown(self):
+        pass
+
+    def getStats(self):
+        return {'sent': self.sent, 'lost': self.lost, 'airtime': self.airtime, 'nodes': len(self.nodes)}
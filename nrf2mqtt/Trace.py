@@ -0,0 +1,157 @@
+#
+# Copyright (c) 2024-2025 Volodymyr "Vova" Tymoshchuk
+# Distributed under MIT licence, https://github.com/vova-tymosh/RCC/blob/main/LICENSE
+# For more details go to https://github.com/vova-tymosh/RCC
+#
+# The above copyright notice shall be included in all
+# copies or substantial portions of the Software.
+#
+#
+# Compact binary packet trace
+#
+# The file is a header followed by records, each record is
+#   time (double, seconds since epoch), direction (byte), reserved (byte), addr (uint16), length (uint16)
+#   and then length bytes of data.
+#   Nrf data is the raw packet (action char + payload), Mqtt data is action + b'\0' + message.
+# Records are queued by the hot path and written by a background thread, the file rotates at maxBytes.
+#  A record that can't be packed (e.g. data over 65535 bytes) is skipped and counted in dropped,
+#  the first one is logged.
+#
+# The same file is a traffic capture: readTrace() walks it through mmap, replay() pushes the
+#  inbound records back into the Broker at the captured pace, N times faster or as fast as possible.
+#
+
+import os
+import mmap
+import time
+import queue
+import struct
+import logging
+import threading
+
+TRACE_MAGIC = b'RCCTRACE\x01\x00\x00\x00'
+TRACE_RECORD = struct.Struct('<dBBHH')
+
+NRF_IN = 0
+NRF_OUT = 1
+MQ_IN = 2
+MQ_OUT = 3
+
+
+class PacketTrace:
+
+    def __init__(self, filename, maxBytes = 8 * 1024 * 1024, backups = 1):
+        self.filename = filename
+        self.maxBytes = maxBytes
+        self.backups = backups
+        self.queue = queue.SimpleQueue()
+        self.file = None
+        self.dropped = 0
+        self.thread = threading.Thread(target = self.writerThread, daemon = True)
+
+    def start(self):
+        self.open()
+        self.thread.start()
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+
+    def record(self, direction, addr, data):
+        self.queue.put((time.time(), direction, int(addr), bytes(data)))
+
+    def recordMq(self, direction, addr, action, message):
+        self.record(direction, addr, bytes(action, 'utf-8') + b'\0' + bytes(message, 'utf-8'))
+
+    def open(self):
+        self.file = open(self.filename, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(TRACE_MAGIC)
+
+    def rotate(self):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.filename}.{i}'):
+                os.replace(f'{self.filename}.{i}', f'{self.filename}.{i + 1}')
+        if self.backups:
+            os.replace(self.filename, f'{self.filename}.1')
+        else:
+            os.remove(self.filename)
+        self.open()
+
+    def writerThread(self):
+        while True:
+            item = self.queue.get()
+            while item is not None:
+                try:
+                    t, direction, addr, data = item
+                    self.file.write(TRACE_RECORD.pack(t, direction, 0, addr & 0xFFFF, len(data)) + data)
+                except (struct.error, ValueError, TypeError) as e:
+                    if self.dropped == 0:
+                        logging.error(f'Trace record skipped: {e}')
+                    self.dropped += 1
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            self.file.flush()
+            if item is None:
+                return
+            if self.file.tell() >= self.maxBytes:
+                self.rotate()
+
+
+def splitMq(data):
+    action, message = data.split(b'\0', 1)
+    return action.decode(), message.decode()
+
+#
+# Generator of (time, direction, addr, data) records, a truncated last record is ignored
+#
+def readTrace(filename):
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size <= len(TRACE_MAGIC):
+            return
+        with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+            if mm[:len(TRACE_MAGIC)] != TRACE_MAGIC:
+                raise ValueError(f'{filename} is not a packet trace')
+            offset = len(TRACE_MAGIC)
+            end = len(mm)
+            while offset + TRACE_RECORD.size <= end:
+                t, direction, reserved, addr, length = TRACE_RECORD.unpack_from(mm, offset)
+                offset += TRACE_RECORD.size
+                if offset + length > end:
+                    return
+                yield t, direction, addr, mm[offset:offset + length]
+                offset += length
+
+#
+# Push inbound records to receiveNrf(addr, action, message) / receiveMq(addr, action, message).
+#  speed - 1 for the captured pace, N for N times faster, 0 for as fast as possible
+#  Returns the number of records pushed.
+#
+def replay(records, receiveNrf, receiveMq, speed = 0):
+    count = 0
+    start = None
+    for t, direction, addr, data in records:
+        if direction == NRF_IN:
+            if len(data) < 1:
+                continue
+            action, message = chr(data[0]), data[1:]
+        elif direction == MQ_IN:
+            action, message = splitMq(data)
+        else:
+            continue
+        if speed:
+            if start is None:
+                start = (time.monotonic(), t)
+            delay = start[0] + (t - start[1]) / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        if direction == NRF_IN:
+            receiveNrf(addr, action, message)
+        else:
+            receiveMq(addr, action, message)
+        count += 1
+    return count
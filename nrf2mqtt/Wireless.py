@@ -16,78 +16,289 @@
 #
 
 import time
-import queue
+import collections
 import threading
 import logging
-from pyrf24 import RF24, RF24Network, RF24NetworkHeader, RF24_PA_LOW, RF24_PA_HIGH, RF24_250KBPS
 
 
+#
+# Radio backend on real NRF24 hardware. Any object with the same methods can be given to Wireless
+#  instead, like the simulated network in Simulator.py.
+#
+class Rf24Backend:
+
+    def __init__(self, cePin, csnPin, channel = None):
+        from pyrf24 import RF24, RF24Network, RF24NetworkHeader, RF24_PA_LOW, RF24_250KBPS
+        self.header = RF24NetworkHeader
+        self.paLevel = RF24_PA_LOW
+        self.dataRate = RF24_250KBPS
+        self.channel = channel
+        self.radio = RF24(cePin, csnPin)
+        self.network = RF24Network(self.radio)
+
+    def begin(self, node):
+        if not self.radio.begin():
+            raise RuntimeError("*** Radio hardware is not responding")
+        self.radio.setPALevel(self.paLevel)
+        self.radio.setDataRate(self.dataRate)
+        if self.channel is not None:
+            self.radio.setChannel(self.channel)
+        self.network.begin(node)
+        # self.radio.printPrettyDetails()
+
+    def update(self):
+        self.network.update()
+
+    def available(self):
+        return self.network.available()
+
+    def read(self):
+        header, payload = self.network.read()
+        return header.from_node, payload
+
+    def write(self, toNode, payload):
+        return self.network.write(self.header(toNode), payload)
+
+    def powerDown(self):
+        self.radio.powerDown()
+
+
+#
+# Per lane send counters, shared by all nodes of a Wireless. Latency is from push to a successful write.
+#
+class LaneStats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.latencySum = 0.0
+        self.latencyMax = 0.0
+
+    def onSent(self, latency):
+        with self.lock:
+            self.sent += 1
+            self.latencySum += latency
+            if latency > self.latencyMax:
+                self.latencyMax = latency
+
+    def onCoalesced(self):
+        with self.lock:
+            self.coalesced += 1
+
+    def onDropped(self):
+        with self.lock:
+            self.dropped += 1
+
+    def get(self):
+        with self.lock:
+            avg = self.latencySum / self.sent if self.sent else 0.0
+            return {'sent': self.sent, 'coalesced': self.coalesced, 'dropped': self.dropped,
+                    'latencyAvg': avg, 'latencyMax': self.latencyMax}
+
+#
+# Outbound queue of a single node, split into priority lanes (lane 0 goes first).
+#  Wireless.classify maps a payload to (lane, key). Messages with the same key carry state,
+#  a newer one replaces the pending one in place. Messages without a key are one-shot and stay FIFO.
+#  The queue is bounded, once full the oldest message of the lowest priority lane is dropped, but only from
+#  the lane of the new message or a less urgent one. If all pending messages are more urgent, the new one is dropped.
+#
+# Link quality: success ratio (moving average), RTT (moving average of the acked write time, RF24Network
+#  write returns once the ack is in) and consecutive failures. After a failure the node is not retried
+#  for a backoff that doubles with every consecutive failure, starts at retryBase or twice the RTT and
+#  is stretched on a poor link, up to retryMax. Any packet heard from the node ends the backoff, and so does
+#  a new lane 0 message (STOP, direction), it gets one immediate attempt instead of waiting the backoff out.
+#
+LINK_ALPHA = 0.1
+
 class WirelessNode:
 
-    def __init__(self, addr, _write, timeout):
+    def __init__(self, addr, _write, timeout, classify = None, maxSize = 64, laneStats = None, retryBase = 0.002, retryMax = 0.5):
         self.addr = int(addr)
         self.write = _write
         self.timeout = timeout
-        self.message = None
-        self.queue = queue.Queue()
+        self.classify = classify
+        self.maxSize = maxSize
+        self.laneStats = laneStats or [LaneStats()]
+        self.lanes = [collections.OrderedDict() for i in self.laneStats]
+        self.size = 0
+        self.lock = threading.Lock()
+        self.seq = 0
         self.sinceError = 0
+        self.retries = 0
+        self.retryBase = retryBase
+        self.retryMax = retryMax
+        self.quality = 1.0
+        self.rtt = 0.0
+        self.consecutiveFailures = 0
+        self.nextTry = 0
+        self.lastSent = 0
 
     def disconncted(self):
         return self.sinceError and time.time() > self.sinceError + self.timeout
 
+    def ready(self, now):
+        return now >= self.nextTry
+
+    def heard(self):
+        self.nextTry = 0
+
+    def onWrite(self, ok, rtt, now):
+        self.lastSent = now
+        self.quality += LINK_ALPHA * ((1.0 if ok else 0.0) - self.quality)
+        if ok:
+            self.rtt = rtt if self.rtt == 0 else self.rtt + LINK_ALPHA * (rtt - self.rtt)
+            self.consecutiveFailures = 0
+            self.nextTry = 0
+        else:
+            self.consecutiveFailures += 1
+            backoff = max(self.retryBase, 2 * self.rtt) * 2 ** min(self.consecutiveFailures - 1, 16) * (2 - self.quality)
+            self.nextTry = now + min(backoff, self.retryMax)
+
+    def getLinkStats(self):
+        return {'quality': round(self.quality, 3), 'rtt': self.rtt, 'consecutiveFailures': self.consecutiveFailures,
+                'retries': self.retries, 'queued': self.size}
+
     def push(self, message):
-        self.queue.put(message)
+        lane, key = self.classify(message) if self.classify else (0, None)
+        lane = min(lane, len(self.lanes) - 1)
+        queue = self.lanes[lane]
+        item = (message, time.monotonic())
+        with self.lock:
+            if lane == 0:
+                self.nextTry = 0
+            if key is None:
+                self.seq += 1
+                key = self.seq
+            elif key in queue:
+                queue[key] = item
+                self.laneStats[lane].onCoalesced()
+                return
+            if self.size >= self.maxSize and not self.dropOldest(lane):
+                self.laneStats[lane].onDropped()
+                return
+            queue[key] = item
+            self.size += 1
+
+    # Drop the oldest message of the least urgent lane from minLane down, False if those are all empty
+    def dropOldest(self, minLane = 0):
+        for lane in range(len(self.lanes) - 1, minLane - 1, -1):
+            if self.lanes[lane]:
+                self.lanes[lane].popitem(last = False)
+                self.size -= 1
+                self.laneStats[lane].onDropped()
+                return True
+        return False
+
+    # Lane of the next message to send or None if nothing is pending
+    def head(self):
+        for lane, queue in enumerate(self.lanes):
+            if queue:
+                return lane
 
     def pop(self):
-        if self.message == None:
-            if self.queue.empty():
+        with self.lock:
+            lane = self.head()
+            if lane is None:
                 return False
-            self.message = self.queue.get(False)
-        if self.write(self.addr, self.message):
-            self.message = None
+            queue = self.lanes[lane]
+            key, item = next(iter(queue.items()))
+        start = time.monotonic()
+        ok = self.write(self.addr, item[0])
+        now = time.monotonic()
+        self.onWrite(ok, now - start, now)
+        if ok:
+            with self.lock:
+                if queue.get(key) is item:
+                    del queue[key]
+                    self.size -= 1
+            self.laneStats[lane].onSent(now - item[1])
             self.sinceError = 0
             return True
         else:
+            self.retries += 1
             if self.sinceError == 0:
                 self.sinceError = time.time()
             return False
 
 class Wireless:
 
-  def __init__(self, cePin, csnPin, timeout = 5):
+  #
+  # pollInterval - how often to poll the radio right after traffic (seconds)
+  # maxPollInterval - the idle poll backoff doubles up to this value while the network is quiet
+  # Writes wake the loop immediately, the backoff only bounds the receive latency.
+  # queueSize - max number of pending messages per node
+  # lanes - number of send priority lanes, lane 0 is the most urgent
+  # classify - optional callback payload -> (lane, key), messages with the same key coalesce in the node queue
+  # backend - radio backend, Rf24Backend on the given pins by default
+  # retryBase, retryMax - per node retry backoff bounds, see WirelessNode
+  # channel - RF channel of the default backend, the radio default if None
+  #
+  def __init__(self, cePin, csnPin, timeout = 5, pollInterval = 0.001, maxPollInterval = 0.02, queueSize = 64, lanes = 1,
+               backend = None, retryBase = 0.002, retryMax = 0.5, channel = None):
     self.STATION_NODE = 0
     self.run = True
     self.onReceive = None
     self.onDisconnect = None
+    self.classify = None
     self.timeout = timeout
+    self.queueSize = queueSize
+    self.laneStats = [LaneStats() for i in range(lanes)]
+    self.retryBase = retryBase
+    self.retryMax = retryMax
+    self.writes = 0
+    self.writeFailures = 0
+    self.disconnects = 0
+    self.pollInterval = pollInterval
+    self.maxPollInterval = maxPollInterval
+    self.idleDelay = pollInterval
+    self.wakeup = threading.Event()
     self.nodes = {}
     self.nodesLock = threading.Lock()
-    self.radio = RF24(cePin, csnPin)
-    self.network = RF24Network(self.radio)
+    self.backend = backend or Rf24Backend(cePin, csnPin, channel)
     self.thread = threading.Thread(target=self.commThread)
 
   def start(self):
-    if not self.radio.begin():
-      raise RuntimeError("*** Radio hardware is not responding")
-    self.radio.setPALevel(RF24_PA_LOW)
-    self.radio.setDataRate(RF24_250KBPS)
-    self.network.begin(self.STATION_NODE)
+    self.backend.begin(self.STATION_NODE)
     self.thread.start()
-    # self.radio.printPrettyDetails()
 
   def stop(self):
     self.run = False
+    self.wakeup.set()
     self.thread.join()
 
   def writeInternal(self, toNode, payload):
-    return self.network.write(RF24NetworkHeader(toNode), payload)
+    self.writes += 1
+    if self.backend.write(toNode, payload):
+      return True
+    self.writeFailures += 1
+    return False
 
-  def write(self, toNode, payload):
+  # Packets to a node not heard yet are dropped, unless create is set
+  def write(self, toNode, payload, create = False):
     toNode = int(toNode)
-    if toNode in self.nodes:
-      self.nodes[toNode].push(payload)
+    if toNode not in self.nodes:
+      if not create:
+        return
+      self.addNode(toNode)
+    self.nodes[toNode].push(payload)
+    self.wakeup.set()
+
+  def addNode(self, addr):
+    with self.nodesLock:
+      if addr not in self.nodes:
+        self.nodes[addr] = WirelessNode(addr, self.writeInternal, self.timeout, self.classify, self.queueSize, self.laneStats,
+                                        self.retryBase, self.retryMax)
+
+  def getLinkStats(self):
+    return {node.addr: node.getLinkStats() for node in list(self.nodes.values())}
+
+  def getLaneStats(self):
+    return [stats.get() for stats in self.laneStats]
 
   def disconnect(self, node):
+    self.disconnects += 1
     if self.onDisconnect:
       self.onDisconnect(node.addr)
     if node.addr in self.nodes:
@@ -97,29 +308,43 @@ class Wireless:
     try:
       while self.run:
         needWait = True
-        self.network.update()
-        if self.network.available():
-          header, payload = self.network.read()
+        self.backend.update()
+        if self.backend.available():
+          fromNode, payload = self.backend.read()
           needWait = False
-          if header.from_node not in self.nodes:
-            with self.nodesLock:
-              self.nodes[header.from_node] = WirelessNode(header.from_node, self.writeInternal, self.timeout)
+          if fromNode not in self.nodes:
+            self.addNode(fromNode)
+          self.nodes[fromNode].heard()
           if len(payload) > 0 and self.onReceive:
-            self.onReceive(header.from_node, payload)
+            self.onReceive(fromNode, payload)
         with self.nodesLock:
           toDisconnect = []
+          # Most urgent lane first, within a lane the node served longest ago, nodes in backoff wait
+          ready = []
+          now = time.monotonic()
           for node in self.nodes.values():
-            if node.pop():
-              needWait = False
+            lane = node.head()
+            if lane is not None and node.ready(now):
+              ready.append((lane, node.lastSent, node.addr, node))
             if node.disconncted():
               toDisconnect.append(node)
+          ready.sort()
+          for lane, lastSent, addr, node in ready:
+            if node.pop():
+              needWait = False
           for node in toDisconnect:
             self.disconnect(node)
 
         if needWait:
-          time.sleep(0.01)
+          if self.wakeup.wait(self.idleDelay):
+            self.wakeup.clear()
+            self.idleDelay = self.pollInterval
+          else:
+            self.idleDelay = min(self.idleDelay * 2, self.maxPollInterval)
+        else:
+          self.idleDelay = self.pollInterval
     finally:
-      self.radio.powerDown()
+      self.backend.powerDown()
 
 
 # # Below is for test only
@@ -0,0 +1,43 @@
+import sys
+import timeit
+sys.path.append("../nrf2mqtt")
+from Comms import *
+
+
+#
+# Microbenchmark of the Translator routing, the precompiled index vs the original linear table scan.
+#   Should be excuted in the same folder as the Comms.py on a machine with RF24 & Paho Mqtt installed
+#
+
+ROUNDS = 200000
+
+mqActions = ['heartbeat/values', 'throttle', 'direction', 'function/3', 'function/name/3', 'value/zupa', 'value/list/req']
+nrfActions = ['H', 'T', 'D', 'F', 'V', 'J']
+
+proto_map = buildTrasnlationMap()
+
+def scanMq(action):
+    for entry in proto_map:
+        if action.startswith(entry.mqTopic):
+            return entry
+
+def scanNrf(action):
+    for entry in proto_map:
+        if action == entry.nrfTopic:
+            return entry
+
+def indexNrf(action):
+    return translator.nrfIndex.get(action)
+
+def bench(name, func, actions, reference):
+    for a in actions:
+        assert func(a).mqTopic == reference(a).mqTopic, a
+    t = timeit.timeit(lambda: [func(a) for a in actions], number=ROUNDS)
+    perCall = t / ROUNDS / len(actions) * 1e9
+    print(f'{name}'.ljust(20) + f'{perCall:8.1f} ns/route')
+    return perCall
+
+for actions, scan, index, side in ((mqActions, scanMq, translator.routeMq, 'toNrf'), (nrfActions, scanNrf, indexNrf, 'toMq')):
+    s = bench(f'{side} scan', scan, actions, scan)
+    i = bench(f'{side} index', index, actions, scan)
+    print(f'{side} speedup'.ljust(20) + f'{s / i:8.2f}x')
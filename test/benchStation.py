@@ -0,0 +1,205 @@
+import sys
+import json
+import time
+import random
+import struct
+import argparse
+import platform
+import tracemalloc
+sys.path.append("../nrf2mqtt")
+import Comms
+
+
+#
+# Throughput and latency benchmark of the station, drives Broker.receiveNrf / Broker.receiveMq
+#  with synthetic fleets through stub transports and saves the results as JSON.
+#   Should be excuted in the same folder as the Comms.py on a machine with Paho Mqtt installed
+#
+# Usage:
+#   python3 benchStation.py --out bench.json
+#   python3 benchStation.py --out new.json --baseline bench.json
+#
+
+FLEETS = [10, 100, 1000]
+HEARTBEAT_FMT = 'IIBBBB'
+ALLOC_SAMPLE = 5000
+
+class StubNrf:
+    def __init__(self):
+        self.written = 0
+
+    def write(self, addr, packet):
+        self.written += 1
+
+class StubMqtt:
+    def __init__(self):
+        self.written = 0
+
+    def write(self, addr, packet, retain = False):
+        self.written += 1
+
+def install(nrf = None, mq = None):
+    Comms.nrf = nrf or StubNrf()
+    Comms.mq = mq or StubMqtt()
+    Comms.broker = Comms.Broker()
+    Comms.translator = Comms.Translator()
+
+#
+# Fleet: locos are NRF nodes 1..n, in the pairs profile every other node is a keypad subscribed to the loco before it
+#
+def introduce(nodes, pairs):
+    for addr in range(1, nodes + 1):
+        if pairs and addr % 2 == 0:
+            Comms.broker.receiveNrf(addr, Comms.NRF_INTRO, bytes(f'K,{addr},Pad{addr},0.9', 'utf-8'))
+            Comms.broker.subscribe(addr, addr - 1)
+        else:
+            Comms.broker.receiveNrf(addr, Comms.NRF_INTRO, bytes(f'L,{addr},Loco{addr},0.9,<{HEARTBEAT_FMT}', 'utf-8'))
+
+def heartbeat(i):
+    return struct.pack('<' + HEARTBEAT_FMT, i, i * 3, 1, 2, 3, 4)
+
+#
+# Traffic profiles, each returns a list of ('nrf' | 'mq', addr, action, message)
+#
+def profileHeartbeat(nodes, count, rnd):
+    traffic = []
+    for i in range(count):
+        addr = rnd.randint(1, nodes)
+        if i % 10 == 9:
+            traffic.append(('mq', addr, 'throttle', str(i % 100)))
+        else:
+            traffic.append(('nrf', addr, Comms.NRF_HEARTBEAT, heartbeat(i)))
+    return traffic
+
+def profileThrottle(nodes, count, rnd):
+    traffic = []
+    for i in range(count):
+        addr = rnd.randint(1, nodes)
+        if i % 20 == 19:
+            traffic.append(('mq', addr, 'direction', rnd.choice(Comms.MQ_DIRECTIONS)))
+        elif i % 20 == 18:
+            traffic.append(('mq', addr, f'function/{i % 29}', rnd.choice(['ON', 'OFF'])))
+        else:
+            traffic.append(('mq', addr, 'throttle', str(i % 100)))
+    return traffic
+
+def profilePairs(nodes, count, rnd):
+    traffic = []
+    for i in range(count):
+        loco = rnd.randrange(1, nodes, 2)
+        if i % 4 == 3:
+            traffic.append(('nrf', loco + 1, 'T', bytes([i % 100])))
+        else:
+            traffic.append(('nrf', loco, Comms.NRF_HEARTBEAT, heartbeat(i)))
+    return traffic
+
+PROFILES = {
+    'heartbeat': (profileHeartbeat, False),
+    'throttle': (profileThrottle, False),
+    'pairs': (profilePairs, True),
+}
+
+def dispatch(traffic):
+    receiveNrf = Comms.broker.receiveNrf
+    receiveMq = Comms.broker.receiveMq
+    for side, addr, action, message in traffic:
+        if side == 'nrf':
+            receiveNrf(addr, action, message)
+        else:
+            receiveMq(addr, action, message)
+
+def measureLatency(traffic):
+    receiveNrf = Comms.broker.receiveNrf
+    receiveMq = Comms.broker.receiveMq
+    clock = time.perf_counter_ns
+    latency = []
+    for side, addr, action, message in traffic:
+        start = clock()
+        if side == 'nrf':
+            receiveNrf(addr, action, message)
+        else:
+            receiveMq(addr, action, message)
+        latency.append(clock() - start)
+    latency.sort()
+    return latency
+
+#
+# Python has no allocation counter, so this reports the transient tracemalloc peak of every message
+#  (bytes allocated on top of what was live before the call) and the blocks still retained afterwards.
+#
+def measureAllocations(traffic):
+    receiveNrf = Comms.broker.receiveNrf
+    receiveMq = Comms.broker.receiveMq
+    transient = 0
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for side, addr, action, message in traffic:
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        if side == 'nrf':
+            receiveNrf(addr, action, message)
+        else:
+            receiveMq(addr, action, message)
+        transient += tracemalloc.get_traced_memory()[1] - current
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    retained = sum(s.count_diff for s in stats if s.count_diff > 0)
+    return transient, retained
+
+def run(profile, nodes, count, seed):
+    build, pairs = PROFILES[profile]
+    install()
+    introduce(nodes, pairs)
+    traffic = build(nodes, count, random.Random(seed))
+    dispatch(traffic[:count // 10])
+
+    start = time.perf_counter()
+    dispatch(traffic)
+    elapsed = time.perf_counter() - start
+
+    latency = measureLatency(traffic)
+    transient, retained = measureAllocations(traffic[:ALLOC_SAMPLE])
+    return {
+        'profile': profile,
+        'nodes': nodes,
+        'messages': count,
+        'msgPerSec': round(count / elapsed),
+        'p50Us': latency[len(latency) // 2] / 1000,
+        'p99Us': latency[len(latency) * 99 // 100] / 1000,
+        'allocBytesPerMsg': transient / min(count, ALLOC_SAMPLE),
+        'retainedBlocksPerMsg': retained / min(count, ALLOC_SAMPLE),
+        'nrfWrites': Comms.nrf.written,
+        'mqWrites': Comms.mq.written,
+    }
+
+def report(results, baseline):
+    base = {(r['profile'], r['nodes']): r for r in baseline.get('results', [])} if baseline else {}
+    for r in results:
+        line = f"{r['profile']:10} {r['nodes']:5} nodes  {r['msgPerSec']:9} msg/s  p50 {r['p50Us']:7.2f}us  p99 {r['p99Us']:7.2f}us"
+        line += f"  {r['allocBytesPerMsg']:7.1f} B/msg"
+        old = base.get((r['profile'], r['nodes']))
+        if old:
+            line += f"  ({(r['msgPerSec'] / old['msgPerSec'] - 1) * 100:+.1f}% msg/s)"
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'RCC Station benchmark')
+    parser.add_argument('--messages', type = int, default = 50000)
+    parser.add_argument('--fleets', type = int, nargs = '+', default = FLEETS)
+    parser.add_argument('--profiles', nargs = '+', default = list(PROFILES), choices = list(PROFILES))
+    parser.add_argument('--seed', type = int, default = 1)
+    parser.add_argument('--out', default = 'bench.json')
+    parser.add_argument('--baseline')
+    args = parser.parse_args()
+
+    results = [run(profile, nodes, args.messages, args.seed) for profile in args.profiles for nodes in args.fleets]
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    with open(args.out, 'w') as f:
+        json.dump({'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(),
+                   'machine': platform.machine(), 'results': results}, f, indent = 2)
@@ -0,0 +1,71 @@
+import sys
+import time
+import struct
+import argparse
+sys.path.append("../nrf2mqtt")
+import Comms
+import Trace
+import Heartbeat
+from benchStation import install
+
+
+#
+# Replay a packet capture (see TRACE_FILE in Comms.py) through the Broker with stub transports.
+#  Reports the replay rate and compares the number of packets the station sent out with the capture.
+#   Should be excuted in the same folder as the Comms.py on a machine with Paho Mqtt installed
+#
+# Usage:
+#   python3 replayTrace.py packets.trace --speed 0
+#   python3 replayTrace.py packets.trace --heartbeats heartbeats.csv
+#
+
+def summary(records):
+    counts = [0, 0, 0, 0]
+    for t, direction, addr, data in records:
+        counts[direction] += 1
+    return counts
+
+#
+# Heartbeats of every loco in the capture decoded in one batch per loco, formats come from the
+#  intros the replay fed into the Broker. Lines are time,addr,values...
+#
+def exportHeartbeats(records, filename):
+    heartbeat = ord(Comms.NRF_HEARTBEAT)
+    perLoco = {}
+    for t, direction, addr, data in records:
+        if direction == Trace.NRF_IN and data[:1] == bytes([heartbeat]):
+            perLoco.setdefault(addr, []).append((t, bytes(data[1:])))
+    start = time.perf_counter()
+    count = 0
+    with open(filename, 'w') as f:
+        for addr, beats in sorted(perLoco.items()):
+            fmt = Comms.broker.getHeartbeatFmt(addr)
+            if fmt is None:
+                continue
+            size = struct.calcsize(fmt)
+            beats = [(t, p) for t, p in beats if len(p) == size]
+            columns = Heartbeat.decodeHeartbeats(fmt, [p for t, p in beats])
+            f.write(Heartbeat.heartbeatsCsv(columns, [t for t, p in beats], addr))
+            count += len(beats)
+    print(f'exported {count} heartbeats of {len(perLoco)} locos in {time.perf_counter() - start:.3f}s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Replay RCC packet capture')
+    parser.add_argument('trace')
+    parser.add_argument('--speed', type = float, default = 0, help = '1 - captured pace, N - N times faster, 0 - max')
+    parser.add_argument('--heartbeats', help = 'also export decoded heartbeats to this CSV file')
+    args = parser.parse_args()
+
+    records = list(Trace.readTrace(args.trace))
+    captured = summary(records)
+    install()
+    start = time.perf_counter()
+    count = Trace.replay(records, Comms.broker.receiveNrf, Comms.broker.receiveMq, args.speed)
+    elapsed = time.perf_counter() - start
+
+    print(f'replayed {count} packets in {elapsed:.3f}s, {count / elapsed:.0f} packets/s')
+    print(f'nrf out: captured {captured[Trace.NRF_OUT]}, replayed {Comms.nrf.written}')
+    print(f'mqtt out: captured {captured[Trace.MQ_OUT]}, replayed {Comms.mq.written}')
+    if args.heartbeats:
+        exportHeartbeats(records, args.heartbeats)
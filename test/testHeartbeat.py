@@ -0,0 +1,64 @@
+import sys
+import struct
+sys.path.append("../nrf2mqtt")
+import Comms
+import Heartbeat
+
+
+#
+# Test of the batch heartbeat decoder: NumPy, struct.iter_unpack and the per-packet translateHeartbeat
+#  must give the same CSV, also for payloads of the wrong size and for no payloads at all.
+#   Should be excuted in the same folder as the Comms.py on a machine with Paho Mqtt installed
+#
+
+def testResult(name, result, expected):
+    print(f'{name}'.ljust(35) + f' ->   {result}'.ljust(60), end='')
+    if result == expected:
+        print('ok')
+    else:
+        print(f'FAIL {expected}')
+
+def perPacketCsv(addr, payloads, times = None):
+    lines = []
+    for i, payload in enumerate(payloads):
+        k, v = Comms.translateHeartbeat(False, addr, 'heartbeat/values', payload)
+        if v:
+            prefix = f'{times[i]:.6f},{addr},' if times is not None else ''
+            lines.append(prefix + v + '\n')
+    return ''.join(lines)
+
+# Rows and whether the CSV matches, the text itself is too long to print
+def compare(result, expected):
+    return result.count('\n'), result == expected
+
+def check(name, addr, fmt, payloads):
+    times = [1700000000.0 + i * 0.1 for i in range(len(payloads))]
+    expected = perPacketCsv(addr, payloads)
+    result = Heartbeat.heartbeatsCsv(Heartbeat.decodeHeartbeats(fmt, payloads, useNumpy = False))
+    testResult(f'{name}, iter_unpack', compare(result, expected), (expected.count('\n'), True))
+    if Heartbeat.numpy is not None:
+        result = Heartbeat.heartbeatsCsv(Heartbeat.decodeHeartbeats(fmt, payloads))
+        testResult(f'{name}, numpy', compare(result, expected), (expected.count('\n'), True))
+    # Rows stay aligned with the times only when every payload has the right size
+    if all(len(p) == struct.calcsize(fmt) for p in payloads):
+        expected = perPacketCsv(addr, payloads, times)
+        result = Heartbeat.heartbeatsCsv(Heartbeat.decodeHeartbeats(fmt, payloads, useNumpy = False), times, addr)
+        testResult(f'{name}, time and addr', compare(result, expected), (expected.count('\n'), True))
+
+
+Comms.broker = Comms.Broker()
+Comms.broker.processIntro(3, 'L,3,Rcc,0.9,<IIBBBB', Comms.PROTO_NRF)
+Comms.broker.processIntro(5, 'L,5,Float,0.9,<Hfb', Comms.PROTO_NRF)
+if Heartbeat.numpy is None:
+    print('NumPy not installed, only the struct.iter_unpack path is checked')
+
+beats = [struct.pack('<IIBBBB', i, i * 3, 1, 2, 3, i % 256) for i in range(300)]
+check('ints', 3, '<IIBBBB', beats)
+check('floats', 5, '<Hfb', [struct.pack('<Hfb', i, i / 7, -i % 128) for i in range(50)])
+check('mixed sizes', 3, '<IIBBBB', [beats[0], b'\x01\x02', beats[1], beats[2] + b'\x00', b'', beats[3]])
+check('empty', 3, '<IIBBBB', [])
+
+columns = Heartbeat.decodeHeartbeats('<IIBBBB', [], useNumpy = False)
+testResult('empty, columns', len(columns), 6)
+testResult('empty columns, time and addr', Heartbeat.heartbeatsCsv(columns, [], 3), '')
+testResult('no columns, addr', Heartbeat.heartbeatsCsv([], addr = 3), '')
@@ -0,0 +1,81 @@
+import sys
+sys.path.append("../nrf2mqtt")
+import Comms
+
+
+#
+# Test of the paged ListCab reply: page size, page header (number and count), reassembly of the list,
+#  the header-less reply to an empty request and the page cache. No radio needed, writes go to a list.
+#   Should be excuted in the same folder as the Comms.py on a machine with Paho Mqtt installed
+#
+
+class StubNrf:
+    def __init__(self):
+        self.written = []
+
+    def write(self, addr, packet):
+        self.written.append(bytes(packet))
+
+class StubMqtt:
+    def write(self, addr, packet, retain = False):
+        pass
+
+def testResult(name, result, expected):
+    print(f'{name}'.ljust(35) + f' ->   {result}'.ljust(60), end='')
+    if result == expected:
+        print('ok')
+    else:
+        print(f'FAIL {expected}')
+
+def listCab(page):
+    Comms.broker.receiveNrf(4, Comms.NRF_LIST_CAB, bytes([page]))
+    return Comms.nrf.written[-1]
+
+def legacyListCab():
+    Comms.broker.receiveNrf(4, Comms.NRF_LIST_CAB, b'')
+    return Comms.nrf.written[-1]
+
+def header(packet):
+    return packet[:1].decode(), packet[1], packet[2]
+
+def entries(packet):
+    body = packet[Comms.NRF_LIST_CAB_HEADER:]
+    return body.split(b',') if body else []
+
+
+Comms.nrf = StubNrf()
+Comms.mq = StubMqtt()
+Comms.broker = Comms.Broker()
+
+Comms.broker.receiveNrf(4, Comms.NRF_INTRO, b'K,4,Pad,0.9')
+reply = listCab(0)
+testResult('one page, header', header(reply), ('C', 0, 1))
+testResult('one page, entries', entries(reply), [b'K', b'4', b'Pad'])
+testResult('past the end', listCab(1), b'C\x01\x01')
+testResult('no page number, legacy', legacyListCab(), b'CK,4,Pad')
+
+for addr in range(10, 60):
+    Comms.broker.receiveNrf(addr, Comms.NRF_INTRO, bytes(f'L,{addr},Loco number {addr},0.9', 'utf-8'))
+count = listCab(0)[2]
+pages = [listCab(i) for i in range(count)]
+testResult('many pages', count > 1, True)
+testResult('page size', max(map(len, pages)) <= Comms.NRF_MAX_PAYLOAD, True)
+testResult('page headers', [header(p) for p in pages], [('C', i, count) for i in range(count)])
+allEntries = sum((entries(p) for p in pages), [])
+testResult('all entries', len(allEntries), 3 * 51)
+testResult('entry not split', all(len(entries(p)) % 3 == 0 for p in pages), True)
+testResult('past the end, many', listCab(count), bytes([ord('C'), count, count]))
+testResult('legacy, first page entries', legacyListCab(), b'C' + pages[0][Comms.NRF_LIST_CAB_HEADER:])
+
+cached = Comms.broker.getCabPages()
+Comms.broker.receiveNrf(10, Comms.NRF_INTRO, b'L,10,Loco number 10,1.0')
+testResult('same entry keeps cache', Comms.broker.getCabPages() is cached, True)
+Comms.broker.receiveNrf(10, Comms.NRF_INTRO, b'L,10,Renamed,1.0')
+testResult('renamed drops cache', Comms.broker.getCabPages() is cached, False)
+testResult('renamed entry', [b'L', b'10', b'Renamed'] == entries(listCab(0))[3:6], True)
+Comms.broker.forget(11)
+testResult('forget', b'11' in entries(listCab(0)), False)
+
+Comms.broker.receiveNrf(7, Comms.NRF_INTRO, bytes('L,7,' + 'x' * 300 + ',0.9', 'utf-8'))
+pages = [listCab(i) for i in range(listCab(0)[2])]
+testResult('long name fits', max(map(len, pages)) <= Comms.NRF_MAX_PAYLOAD, True)
@@ -41,18 +41,17 @@ testIntro = [
 ('cab/4/intro+L,4,Rcc,0.9,BBB',        b'AL,5,Rcc,0.9,BBB'),
 ]
 
-broker.addr = 0
-broker.known[broker.addr] = {'Format': broker.updateFmt('BBBI')}
+broker.known.add(Node(3, NRF_TYPE_LOCO, 'Rcc', '0.9', PROTO_NRF, broker.updateFmt('BBBI')))
 
 def testToNrf(incoming):
     topic, message = incoming.split('+')
     topic = MQ_MESSAGE.match(topic)
     addr, action = topic.groups()
-    return translator.toNrf(action, message)
+    return translator.toNrf(int(addr), action, message)
 
-def testToMq(incoming):
+def testToMq(incoming, addr = 3):
     action, message = (chr(incoming[0]), incoming[1:])
-    traslated = translator.toMq(action, message)
+    traslated = translator.toMq(addr, action, message)
     if traslated:
         topic, msg = traslated
         return 'cab/3/' + topic + '+' + msg
@@ -83,11 +82,9 @@ for mq, nrf in testProtocolBoth + testProtocolToMq:
     testResult(nrf, mqAct, mq)
 
 for mq, nrf in testIntro:
-    broker.addr = 4
     nrfAct = testToNrf(mq)
     testResult(mq, str(broker.known[4]), "{'Type': 'L', 'Addr': '4', 'Name': 'Rcc', 'Version': '0.9', 'Proto': 'MQ', 'Format': '<BB'}", "map")
-    broker.addr = 5
-    mqAct = testToMq(nrf)
+    mqAct = testToMq(nrf, 5)
     testResult(nrf, str(broker.known[5]), "{'Type': 'L', 'Addr': '5', 'Name': 'Rcc', 'Version': '0.9', 'Proto': 'NRF', 'Format': '<BB'}", "map")
 
 
@@ -0,0 +1,94 @@
+import sys
+import time
+sys.path.append("../nrf2mqtt")
+import Comms
+from Simulator import *
+
+
+#
+# Test of the full Broker path on the simulated radio, no NRF hardware needed.
+#   Should be excuted in the same folder as the Comms.py on a machine with Paho Mqtt installed
+#
+
+class StubMqtt:
+    def __init__(self):
+        self.written = []
+
+    def write(self, addr, packet, retain = False):
+        self.written.append((int(addr), packet[0], packet[1]))
+
+def testResult(name, result, expected):
+    print(f'{name}'.ljust(35) + f' ->   {result}'.ljust(42), end='')
+    if result == expected:
+        print('ok')
+    else:
+        print(f'FAIL {expected}')
+
+
+radio = SimRadio(latency = 0.001, seed = 1)
+loco = radio.addNode(SimLoco(3, 'Rcc', heartbeatPeriod = 0.05))
+keypad = radio.addNode(SimKeypad(4, 'Pad', subscribeTo = 3, throttlePeriod = 0.1))
+
+Comms.nrf = Comms.TransportNrf(backend = radio)
+Comms.mq = StubMqtt()
+Comms.nrf.start()
+time.sleep(1)
+Comms.nrf.stop()
+
+heartbeats = [m for a, t, m in Comms.mq.written if a == 3 and t == 'heartbeat/values']
+throttles = [m for a, t, m in Comms.mq.written if a == 3 and t == 'throttle']
+toLoco = [p for t, p in loco.received if p[:1] == b'T']
+
+testResult('intro loco', getattr(Comms.broker.known.get(3), 'name', None), 'Rcc')
+testResult('intro keypad', getattr(Comms.broker.known.get(4), 'type', None), NRF_TYPE_KEYPAD)
+testResult('subscription', Comms.broker.getForwardNrf(4), 3)
+testResult('heartbeats to mqtt', len(heartbeats) > 10, True)
+testResult('heartbeat decoded', heartbeats[0].endswith(',0,0,0,0,0'), True)
+testResult('throttle to mqtt', len(throttles) > 5, True)
+testResult('throttle to loco', len(toLoco) > 5, True)
+print(radio.getStats())
+
+#
+# Two radios under one Broker, each node is routed through the radio it is heard on
+#
+radioA = SimRadio(seed = 2)
+radioB = SimRadio(seed = 3)
+locoA = radioA.addNode(SimLoco(5, 'RccA', heartbeatPeriod = 0.05))
+locoB = radioB.addNode(SimLoco(6, 'RccB', heartbeatPeriod = 0.05))
+
+Comms.broker = Comms.Broker()
+Comms.nrf = Comms.TransportNrf(radios = [{'backend': radioA}, {'backend': radioB}])
+Comms.mq = StubMqtt()
+Comms.nrf.start()
+time.sleep(0.5)
+Comms.broker.receiveMq(5, 'throttle', '10')
+Comms.broker.receiveMq(6, 'throttle', '20')
+time.sleep(0.1)
+Comms.nrf.stop()
+
+testResult('two radios, intro', (getattr(Comms.broker.known.get(5), 'name', None), getattr(Comms.broker.known.get(6), 'name', None)), ('RccA', 'RccB'))
+testResult('two radios, throttle A', [p for t, p in locoA.received if p[:1] == b'T'], [b'T\n'])
+testResult('two radios, throttle B', [p for t, p in locoB.received if p[:1] == b'T'], [b'T\x14'])
+print(Comms.nrf.getStats())
+
+#
+# A radio with a 'nodes' range reaches a node it has not heard yet, the first radio does not
+#
+class QuietNode(SimNode):
+    def start(self, now):
+        pass
+
+radioA = SimRadio(seed = 4)
+radioB = SimRadio(seed = 5)
+quietA = radioA.addNode(QuietNode(8, NRF_TYPE_LOCO, 'QuietA'))
+quietB = radioB.addNode(QuietNode(7, NRF_TYPE_LOCO, 'QuietB'))
+
+Comms.nrf = Comms.TransportNrf(radios = [{'backend': radioA}, {'backend': radioB, 'nodes': range(7, 8)}])
+Comms.nrf.start()
+Comms.nrf.write(7, b'T\x1e')
+Comms.nrf.write(8, b'T\x1e')
+time.sleep(0.1)
+Comms.nrf.stop()
+
+testResult('range radio, not heard', [p for t, p in quietB.received], [b'T\x1e'])
+testResult('first radio, not heard', [p for t, p in quietA.received], [])
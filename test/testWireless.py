@@ -0,0 +1,98 @@
+import sys
+import time
+sys.path.append("../nrf2mqtt")
+import Comms
+from Wireless import WirelessNode, LaneStats
+
+
+#
+# Test of the node send queue: priority lanes, coalescing of state messages, drops of a full queue
+#  and the retry backoff. No radio needed, writes go to a list.
+#   Should be excuted in the same folder as the Comms.py on a machine with Paho Mqtt installed
+#
+
+class Link:
+    def __init__(self):
+        self.ok = True
+        self.written = []
+
+    def write(self, addr, payload):
+        self.written.append(bytes(payload))
+        return self.ok
+
+def testResult(name, result, expected):
+    print(f'{name}'.ljust(35) + f' ->   {result}'.ljust(60), end='')
+    if result == expected:
+        print('ok')
+    else:
+        print(f'FAIL {expected}')
+
+def makeNode(link, maxSize = 64):
+    lanes = [LaneStats() for i in range(4)]
+    return WirelessNode(3, link.write, 5, Comms.nrfClassify, maxSize, lanes, 0.002, 0.5), lanes
+
+def drain(node):
+    while node.pop():
+        pass
+
+
+link = Link()
+node, lanes = makeNode(link)
+for packet in [b'Jx', b'F3,1', b'T\x10', b'D\x01']:
+    node.push(packet)
+drain(node)
+testResult('lane order', link.written, [b'D\x01', b'T\x10', b'F3,1', b'Jx'])
+
+link = Link()
+node, lanes = makeNode(link)
+for packet in [b'T\x01', b'F3,1', b'T\x02', b'F4,1', b'F3,0', b'T\x03']:
+    node.push(packet)
+drain(node)
+testResult('coalescing', link.written, [b'T\x03', b'F3,0', b'F4,1'])
+testResult('coalesced count', [s.get()['coalesced'] for s in lanes], [0, 2, 1, 0])
+
+link = Link()
+node, lanes = makeNode(link)
+for packet in [b'Jx', b'Jy', b'Jx']:
+    node.push(packet)
+drain(node)
+testResult('one-shot stay FIFO', link.written, [b'Jx', b'Jy', b'Jx'])
+
+link = Link()
+node, lanes = makeNode(link, maxSize = 4)
+for packet in [b'F0,1', b'F1,1', b'F2,1', b'F3,0']:
+    node.push(packet)
+node.push(b'Jx')
+drain(node)
+testResult('full, bulk is dropped', link.written, [b'F0,1', b'F1,1', b'F2,1', b'F3,0'])
+
+link = Link()
+node, lanes = makeNode(link, maxSize = 4)
+for packet in [b'Jx', b'F0,1', b'F1,1', b'F2,1']:
+    node.push(packet)
+node.push(b'F3,0')
+node.push(b'D\x02')
+drain(node)
+testResult('full, less urgent dropped', link.written, [b'D\x02', b'F1,1', b'F2,1', b'F3,0'])
+testResult('dropped count', [s.get()['dropped'] for s in lanes], [0, 0, 1, 1])
+
+link = Link()
+node, lanes = makeNode(link, maxSize = 2)
+node.push(b'D\x01')
+node.push(b'T\x01')
+node.push(b'F0,1')
+drain(node)
+testResult('full of urgent, new dropped', link.written, [b'D\x01', b'T\x01'])
+
+link = Link()
+node, lanes = makeNode(link)
+link.ok = False
+node.push(b'F3,1')
+node.pop()
+node.pop()
+now = time.monotonic()
+testResult('backoff after failure', node.ready(now), False)
+node.push(b'Jx')
+testResult('bulk waits the backoff', node.ready(now), False)
+node.push(b'D\x01')
+testResult('STOP ends the backoff', (node.ready(now), node.head()), (True, 0))